@@ -0,0 +1 @@
+# pytest puts this directory on sys.path for the tests, so custom_scripts imports as it does for the pages
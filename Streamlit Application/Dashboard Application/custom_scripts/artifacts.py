@@ -0,0 +1,91 @@
+import os
+import time
+
+import joblib
+
+from custom_scripts.trees import check_parity, compile_model
+
+# Compact model artifacts, written next to each pickle by
+#   python -m custom_scripts.artifacts
+#
+# A grid search is replaced by its best estimator and state only used while fitting is dropped. Tree ensembles are
+# saved as their flattened custom_scripts.trees form once it reproduces the original predictions. Other XGBoost
+# models are saved in the native UBJSON format, which loads without unpickling and across library versions. Artifacts
+# are dumped uncompressed so joblib can memory-map their arrays, letting every process serving the models share the
+# same pages of the file instead of holding a private copy.
+
+TRAINING_ONLY_ATTRIBUTES = ['cv_results_', 'oob_score_', 'oob_prediction_', 'oob_decision_function_']
+
+
+def compact_paths(path):
+    base = os.path.splitext(path)[0]
+    return base + '.compact.joblib', base + '.compact.ubj'
+
+
+def _is_xgboost(model):
+    return type(model).__module__.startswith('xgboost')
+
+
+def strip(model):
+    model = getattr(model, 'best_estimator_', model)
+    for attr in TRAINING_ONLY_ATTRIBUTES:
+        model.__dict__.pop(attr, None)
+    # fitted sub-estimators of ensembles and pipelines
+    for value in model.__dict__.values():
+        for inner in value if isinstance(value, (list, tuple)) else [value]:
+            inner = inner[-1] if isinstance(inner, tuple) else inner
+            if hasattr(inner, 'get_params') and not _is_xgboost(inner):
+                strip(inner)
+    return model
+
+
+def export(path):
+    # returns the artifact written and how the model was stored
+    model = strip(joblib.load(path))
+    joblib_path, native_path = compact_paths(path)
+    for stale in compact_paths(path):
+        if os.path.exists(stale):
+            os.remove(stale)
+    try:
+        compiled = compile_model(model)
+        difference, matches = check_parity(model, compiled)
+        if matches:
+            joblib.dump(compiled, joblib_path)
+            return joblib_path, f'flattened, max difference {difference:.3g}'
+        note = f'flattened predictions differ by up to {difference:.3g}'
+    except NotImplementedError as e:
+        note = f'cannot be flattened ({e})'
+    if _is_xgboost(model):
+        model.save_model(native_path)
+        return native_path, note
+    joblib.dump(model, joblib_path)
+    return joblib_path, note
+
+
+def load_model(path):
+    # the compact artifact when it is at least as new as the pickle (or the pickle was not shipped), else the pickle
+    source_mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+    joblib_path, native_path = compact_paths(path)
+    if os.path.exists(native_path) and os.path.getmtime(native_path) >= source_mtime:
+        from xgboost import XGBRegressor
+        model = XGBRegressor()
+        model.load_model(native_path)
+        return model
+    if os.path.exists(joblib_path) and os.path.getmtime(joblib_path) >= source_mtime:
+        return joblib.load(joblib_path, mmap_mode='r')
+    return joblib.load(path)
+
+
+if __name__ == '__main__':
+    from custom_scripts.prediction import RESALE_MODELS, RENTAL_MODELS
+
+    for path in [*RESALE_MODELS.values(), *RENTAL_MODELS.values()]:
+        if not os.path.exists(path):
+            print(f'{path}: not found, skipped')
+            continue
+        start = time.perf_counter()
+        compact_path, note = export(path)
+        load_start = time.perf_counter()
+        load_model(path)
+        print(f'{path} ({os.path.getsize(path) / 2**20:.1f} MB) -> {compact_path} ({os.path.getsize(compact_path) / 2**20:.1f} MB), '
+              f'{note}, exported in {load_start - start:.1f}s, loads in {time.perf_counter() - load_start:.2f}s')
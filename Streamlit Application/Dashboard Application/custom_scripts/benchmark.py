@@ -0,0 +1,362 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_scripts.datastore import DATA_DIR, STORE_DIR
+
+# Benchmarks of the dashboard's hot paths on synthetic data: ingesting the CSVs, every page run headlessly through
+# Streamlit's AppTest (first run and rerun), the town heatmap, listing encoding and every model's predict. Each scale
+# gets a workspace under data/store/benchmarks/ holding data.gov.sg-shaped CSVs at that multiple of the current
+# transaction volume (auxillary/ and models/ are linked in), and every benchmark runs in a fresh process there,
+# reporting wall time, peak RSS and the peak of the memory traced by tracemalloc. Runs are compared with a saved
+# baseline so a regression shows up as a flagged row and a non-zero exit status. From the dashboard directory:
+#   python -m custom_scripts.benchmark                          # scales 1 and 10
+#   python -m custom_scripts.benchmark --scales 1 10 100 --only page
+#   python -m custom_scripts.benchmark --save-baseline
+
+# the dashboard directory, benchmarks run with their workspace as the working directory
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(APP_DIR, STORE_DIR, 'benchmarks')
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+# approximate rows of the data.gov.sg files at 1x, per resale period file and for the rental file. The last period
+# stops where auxillary/cpi_mod.csv does, so the latest listings can be priced
+RESALE_PERIODS = [(1990, 1999, 287_000), (2000, 2011, 370_000), (2012, 2014, 52_000), (2015, 2016, 37_000), (2017, 2023, 190_000)]
+RENTAL_PERIOD = (2021, 2023, 120_000)
+
+# synthetic rows generated and written at a time
+CHUNK_ROWS = 1_000_000
+
+PAGES = ['Home.py', 'pages/1_HDB Rentals.py', 'pages/2_HDB Resales.py', 'pages/3_HDB Compare.py',
+         'pages/4_Predict Resale.py', 'pages/5_Predict Rental.py']
+
+# listings priced per run by the batch predict benchmarks at 1x
+PREDICT_ROWS = 1000
+
+# slower than the baseline's median by more than this fraction counts as a regression
+REGRESSION_TOLERANCE = 0.25
+
+RESALE_FLAT_TYPES = ['2 ROOM', '3 ROOM', '4 ROOM', '5 ROOM', 'EXECUTIVE']
+RENTAL_FLAT_TYPES = ['2-ROOM', '3-ROOM', '4-ROOM', '5-ROOM', 'EXECUTIVE']
+FLAT_MODELS = ['Improved', 'New Generation', 'Model A', 'Standard', 'Simplified', 'Apartment', 'Maisonette', 'Premium Apartment']
+STOREY_RANGES = ['01 TO 03', '04 TO 06', '07 TO 09', '10 TO 12', '13 TO 15', '16 TO 18']
+
+
+def workspace(scale):
+    return os.path.join(BENCHMARK_DIR, f'scale-{scale:g}')
+
+
+def _months(first_year, last_year, rng, n):
+    return pd.period_range(f'{first_year}-01', f'{last_year}-12', freq='M')[rng.integers(0, (last_year - first_year + 1) * 12, n)].strftime('%Y-%m')
+
+
+def _resale_chunk(first_year, last_year, streets, rng, n):
+    rows = rng.integers(0, len(streets), n)
+    area = rng.uniform(35, 150, n).round()
+    lease = rng.integers(1966, min(last_year, 2020) + 1, n)
+    df = pd.DataFrame({
+        'month': _months(first_year, last_year, rng, n),
+        'town': streets['town'].to_numpy()[rows],
+        'flat_type': rng.choice(RESALE_FLAT_TYPES, n),
+        'block': rng.integers(1, 900, n).astype(str),
+        'street_name': streets['street_name'].to_numpy()[rows],
+        'storey_range': rng.choice(STOREY_RANGES, n),
+        'floor_area_sqm': area,
+        'flat_model': rng.choice(FLAT_MODELS, n),
+        'lease_commence_date': lease,
+        'resale_price': (area * rng.uniform(2000, 7000, n)).round(-3),
+    })
+    if first_year >= 2015:
+        # the later files carry remaining_lease as text, which ingest derives again
+        df.insert(9, 'remaining_lease', (99 + lease - first_year).astype(str) + ' years')
+    return df
+
+
+def _rental_chunk(first_year, last_year, streets, rng, n):
+    rows = rng.integers(0, len(streets), n)
+    return pd.DataFrame({
+        'rent_approval_date': _months(first_year, last_year, rng, n),
+        'town': streets['town'].to_numpy()[rows],
+        'block': rng.integers(1, 900, n).astype(str),
+        'street_name': streets['street_name'].to_numpy()[rows],
+        'flat_type': rng.choice(RENTAL_FLAT_TYPES, n),
+        'monthly_rent': rng.integers(20, 120, n) * 50,
+    })
+
+
+def _write_csv(path, make_chunk, first_year, last_year, rows, streets, rng):
+    with open(path + '.tmp', 'w') as f:
+        for start in range(0, rows, CHUNK_ROWS):
+            chunk = make_chunk(first_year, last_year, streets, rng, min(CHUNK_ROWS, rows - start))
+            chunk.to_csv(f, header=start == 0, index=False)
+    os.replace(path + '.tmp', path)
+
+
+def _planning_areas(streets):
+    # a box around each town's streets, for running without the real boundaries
+    features = []
+    for town, group in streets.groupby('town'):
+        lat, lng, d = group['lat'].mean(), group['lng'].mean(), 0.01
+        ring = [[lng - d, lat - d], [lng + d, lat - d], [lng + d, lat + d], [lng - d, lat + d], [lng - d, lat - d]]
+        features.append({'type': 'Feature', 'properties': {'PLN_AREA_N': town, 'PLN_AREA_C': town[:2]},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def prepare_workspace(scale, log=print):
+    # generated once per scale, the marker written last
+    directory = workspace(scale)
+    marker = os.path.join(directory, DATA_DIR, 'synthetic.json')
+    if os.path.exists(marker):
+        return directory
+    from custom_scripts.geometry import BOUNDARIES_PATH
+
+    start = time.perf_counter()
+    os.makedirs(os.path.join(directory, DATA_DIR), exist_ok=True)
+    for link in ['auxillary', 'models']:
+        if not os.path.exists(os.path.join(directory, link)):
+            os.symlink(os.path.join(APP_DIR, link), os.path.join(directory, link))
+    streets = pd.read_csv(os.path.join(APP_DIR, 'auxillary', 'streets_towns.csv'))
+    rng = np.random.default_rng(0)
+    rows = {}
+    for first_year, last_year, n in RESALE_PERIODS:
+        path = os.path.join(directory, DATA_DIR, f'ResaleFlatPrices{first_year}-{last_year}.csv')
+        _write_csv(path, _resale_chunk, first_year, last_year, round(n * scale), streets, rng)
+        rows[os.path.basename(path)] = round(n * scale)
+    first_year, last_year, n = RENTAL_PERIOD
+    _write_csv(os.path.join(directory, DATA_DIR, 'RentingOutOfFlats.csv'), _rental_chunk, first_year, last_year, round(n * scale), streets, rng)
+    rows['RentingOutOfFlats.csv'] = round(n * scale)
+    boundaries = os.path.join(directory, BOUNDARIES_PATH)
+    if os.path.exists(os.path.join(APP_DIR, BOUNDARIES_PATH)):
+        os.symlink(os.path.join(APP_DIR, BOUNDARIES_PATH), boundaries)
+    else:
+        with open(boundaries, 'w') as f:
+            json.dump(_planning_areas(streets), f)
+    with open(marker, 'w') as f:
+        json.dump({'scale': scale, 'rows': rows}, f, indent=1)
+    log(f'{scale:g}x: {sum(rows.values())} synthetic transactions -> {directory} in {time.perf_counter() - start:.0f}s')
+    return directory
+
+
+# Benchmarks. Each is (setup, run, repeats): setup(scale) builds the state outside the timing, run(state) is timed
+# repeats times, each in the same fresh process
+
+def _ingest(name):
+    from custom_scripts.datastore import ingest
+    return lambda scale: name, ingest, 1
+
+
+def _page_first_run(page):
+    from streamlit.testing.v1 import AppTest
+
+    def run(path):
+        at = AppTest.from_file(path, default_timeout=3600).run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+    return lambda scale: os.path.join(APP_DIR, page), run, 1
+
+
+def _page_rerun(page):
+    from streamlit.testing.v1 import AppTest
+
+    def setup(scale):
+        return AppTest.from_file(os.path.join(APP_DIR, page), default_timeout=3600).run()
+
+    def run(at):
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+    return setup, run, 5
+
+
+def _heatmap():
+    from custom_scripts.cube import rollup
+    from custom_scripts.datastore import load_cube
+    from custom_scripts.heatmap import heatmap_html
+
+    def setup(scale):
+        values = rollup(load_cube('resale')[0], 'town')['mean']
+        return tuple(zip(values.index.astype(str), values.astype(float)))
+
+    def run(values):
+        heatmap_html.clear()
+        heatmap_html('resale_price', values)
+    return setup, run, 5
+
+
+def _listings(name, rows):
+    from custom_scripts.datastore import load_dataset
+    from custom_scripts.feature_store import prepare_listings
+
+    df = load_dataset(name)
+    return prepare_listings(name, df.iloc[-rows:].reset_index(drop=True))
+
+
+def _encoder(name):
+    from custom_scripts.prediction import create_rental_encoder, create_resale_encoder
+    return create_resale_encoder() if name == 'resale' else create_rental_encoder()
+
+
+def _encode_row(name):
+    # the predict pages' create_df_for_prediction
+    def setup(scale):
+        listing = _listings(name, 1).iloc[0]
+        return _encoder(name), {key: (value.item() if hasattr(value, 'item') else value) for key, value in listing.items()}
+    return setup, lambda state: state[0].encode_row(state[1]), 200
+
+
+def _encode_batch(name):
+    def setup(scale):
+        return _encoder(name), _listings(name, round(PREDICT_ROWS * scale))
+    return setup, lambda state: state[0].encode(state[1]), 5
+
+
+def _predict(name, model, rows):
+    from custom_scripts.artifacts import load_model
+    from custom_scripts.prediction import RENTAL_COLUMNS, RENTAL_MODELS, RESALE_COLUMNS, RESALE_MODELS
+
+    def setup(scale):
+        # rows == 0 prices the single listing a predict page does
+        n = round(rows * scale) if rows else 1
+        paths, columns = (RESALE_MODELS, RESALE_COLUMNS) if name == 'resale' else (RENTAL_MODELS, RENTAL_COLUMNS)
+        features, valid = _encoder(name).encode(_listings(name, n))
+        if not valid.any():
+            raise ValueError('none of the listings could be encoded')
+        return load_model(paths[model]), pd.DataFrame(features[valid], columns=columns)
+    return setup, lambda state: state[0].predict(state[1]), 20 if rows == 0 else 5
+
+
+def benchmarks():
+    # name -> factory of (setup, run, repeats), in the order they run: ingest first, so the pages read a fresh store
+    from custom_scripts.datastore import SOURCES
+    from custom_scripts.prediction import RENTAL_MODELS, RESALE_MODELS
+
+    factories = {f'ingest {name}': lambda name=name: _ingest(name) for name in SOURCES}
+    for page in PAGES:
+        title = os.path.splitext(os.path.basename(page))[0]
+        factories[f'page {title} first run'] = lambda page=page: _page_first_run(page)
+        factories[f'page {title} rerun'] = lambda page=page: _page_rerun(page)
+    factories['heatmap'] = _heatmap
+    for name, paths in [('resale', RESALE_MODELS), ('rental', RENTAL_MODELS)]:
+        factories[f'encode_row {name}'] = lambda name=name: _encode_row(name)
+        factories[f'encode {name} batch'] = lambda name=name: _encode_batch(name)
+        for model in paths:
+            factories[f'predict {name} {model} single'] = lambda name=name, model=model: _predict(name, model, 0)
+            factories[f'predict {name} {model} batch'] = lambda name=name, model=model: _predict(name, model, PREDICT_ROWS)
+    return factories
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_child(benchmark, scale, trace):
+    # runs in the workspace, prints its result as the last line of stdout
+    setup, run, repeats = benchmarks()[benchmark]()
+    state = setup(scale)
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+        return {'peak_alloc_mb': peak / 1024 ** 2}
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    return {'median_ms': float(np.median(times)) * 1000, 'min_ms': min(times) * 1000, 'repeats': repeats,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def _spawn(benchmark, scale, trace):
+    args = [sys.executable, '-m', 'custom_scripts.benchmark', '--child', benchmark, '--scales', f'{scale:g}']
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [APP_DIR, os.environ.get('PYTHONPATH')]))}
+    done = subprocess.run(args + (['--trace'] if trace else []), cwd=workspace(scale), env=env, capture_output=True, text=True)
+    lines = done.stdout.strip().splitlines()
+    if done.returncode or not lines:
+        return {'error': (done.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(lines[-1])
+
+
+def compare(results, baseline):
+    # marks every result slower than its baseline by more than REGRESSION_TOLERANCE
+    for key, result in results.items():
+        before = baseline.get(key, {}).get('median_ms')
+        if before and 'median_ms' in result:
+            result['change'] = result['median_ms'] / before - 1
+            result['regression'] = result['change'] > REGRESSION_TOLERANCE
+    return results
+
+
+def _format(result):
+    if 'error' in result:
+        return f"error: {result['error']}"
+    text = f"{result['median_ms']:10.1f} ms median {result['min_ms']:10.1f} ms min"
+    if result.get('peak_rss_mb') is not None:
+        text += f" {result['peak_rss_mb']:8.0f} MB rss"
+    if result.get('peak_alloc_mb') is not None:
+        text += f" {result['peak_alloc_mb']:8.1f} MB alloc"
+    if 'change' in result:
+        text += f" {result['change']:+7.0%}" + (' REGRESSION' if result['regression'] else '')
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard pages and predictors on synthetic data')
+    parser.add_argument('--scales', nargs='+', type=float, default=[1, 10], help='multiples of the current transaction volume')
+    parser.add_argument('--only', nargs='+', help='benchmarks whose name contains any of these, e.g. page heatmap')
+    parser.add_argument('--no-trace', action='store_true', help='skip the tracemalloc run of every benchmark')
+    parser.add_argument('--save-baseline', action='store_true', help='save this run as the baseline later runs compare with')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_child(args.child, args.scales[0], args.trace)))
+        return
+
+    names = [name for name in benchmarks() if not args.only or any(part in name for part in args.only)]
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    results = {}
+    for scale in args.scales:
+        prepare_workspace(scale)
+        for name in names:
+            key = f'{name} @ {scale:g}x'
+            result = _spawn(name, scale, trace=False)
+            if not args.no_trace and 'error' not in result:
+                result.update(_spawn(name, scale, trace=True))
+            results[key] = compare({key: result}, baseline)[key]
+            print(f'{key:55} {_format(result)}', flush=True)
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DIR, time.strftime('results-%Y%m%d-%H%M%S.json'))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.save_baseline:
+        # merged, so saving a partial run keeps the other benchmarks' baselines
+        with open(BASELINE_PATH + '.tmp', 'w') as f:
+            json.dump({**baseline, **{key: result for key, result in results.items() if 'error' not in result}}, f, indent=1)
+        os.replace(BASELINE_PATH + '.tmp', BASELINE_PATH)
+    regressions = [key for key, result in results.items() if result.get('regression')]
+    print(f"{len(results)} results -> {path}" + (f', {len(regressions)} regressions' if regressions else ''))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import io
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from PIL import Image
+from matplotlib.colors import LinearSegmentedColormap, LogNorm, to_hex
+from matplotlib.figure import Figure
+
+from custom_scripts.cube import density_quantiles
+from custom_scripts.instrument import count, span
+
+# Charts for the trend pages, drawn from the aggregated series the pages already compute (a few dozen values each).
+# The matplotlib backend renders a chart to PNG once per distinct (kind, series, options) and caches the bytes, so a
+# rerun with unchanged filters redraws nothing. Figures are built as plain Figure objects rather than through pyplot,
+# which keeps every open figure in a global registry until it is closed; they are dropped as soon as they are saved.
+# The vega-lite backend sends the same series to the browser as a Vega-Lite spec instead, which is interactive and
+# leaves the server nothing to render.
+#
+# The transactions behind a line are drawn from their per-month price histogram (custom_scripts.cube.density_grid)
+# rather than one marker per row, so the cost depends on the number of bins, not of transactions: as a 2D histogram
+# shaded by the number of transactions with matplotlib, and as percentile bands with Vega-Lite.
+
+BACKENDS = ['matplotlib', 'vega-lite']
+
+# what st.pyplot saves a figure with
+SAVEFIG_OPTIONS = {'format': 'png', 'dpi': 200, 'bbox_inches': 'tight'}
+
+# st.image scales wider images down to this on every call, so the cached PNG is scaled down once instead
+MAX_IMAGE_WIDTH = 1460
+
+# Vega-Lite chart height per inch of the matplotlib figure height
+VEGA_PIXELS_PER_INCH = 50
+
+# from one transaction (the colour the scatter used) to the busiest bin
+DENSITY_CMAP = LinearSegmentedColormap.from_list('density', ['lightblue', 'steelblue'])
+
+# (low, high, opacity) of the Vega-Lite percentile bands, outermost first
+DENSITY_BANDS = [(0.01, 0.99, 0.4), (0.25, 0.75, 0.7)]
+
+
+def chart_backend():
+    # the sidebar switch between the two backends, rendered PNGs by default
+    interactive = st.sidebar.toggle('Interactive charts', help='Draw the charts in the browser (Vega-Lite) instead of as images')
+    return BACKENDS[1] if interactive else BACKENDS[0]
+
+
+def _draw(ax, kind, series, options):
+    if kind == 'pie':
+        series.plot(kind='pie', autopct='%1.0f%%', ax=ax)
+        ax.set_ylabel('')
+    elif kind == 'hist':
+        # one filled step outline per column as seaborn's histplot(element='step') draws hues, with its KDE curve
+        edges = np.append(series.index, series.index[-1] + options['bin_width'])
+        kde = options.get('kde')
+        for i, column in enumerate(series.columns):
+            ax.stairs(series[column], edges, fill=True, alpha=0.25, color=f'C{i}')
+            ax.stairs(series[column], edges, color=f'C{i}', label=column)
+            if kde is not None:
+                ax.plot(kde.index, kde[column], color=f'C{i}')
+        ax.legend(title=options.get('legend'))
+    elif kind == 'heatmap':
+        mesh = ax.pcolormesh(series.columns, series.index, series.to_numpy(), cmap=options.get('cmap'), shading='nearest')
+        ax.figure.colorbar(mesh, ax=ax, label=options.get('legend'))
+    elif kind == 'line':
+        series.plot(color=options.get('color'), ax=ax)
+        if isinstance(series, pd.DataFrame):
+            ax.legend(title=options.get('legend'))
+        density = options.get('density')
+        if density is not None:
+            months, edges, counts = density
+            ax.pcolormesh(np.append(months, months[-1] + 1) - 0.5, edges, np.ma.masked_equal(counts, 0), cmap=DENSITY_CMAP,
+                          norm=LogNorm(vmin=1, vmax=max(counts.max(), 2)), shading='flat')
+    else:
+        series.plot(kind=kind, color=options.get('color'), rot=options.get('rotation'), ax=ax)
+    if 'xlim' in options:
+        ax.set_xlim(*options['xlim'])
+    ax.set_title(options['title'])
+    if kind != 'pie':
+        ax.set_xlabel(options.get('xlabel', ''))
+        ax.set_ylabel(options.get('ylabel', ''))
+    if kind not in ('pie', 'hist', 'heatmap'):
+        ax.grid(linestyle='--')
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def render_png(kind, series, options):
+    # keyed on the hash of the aggregated series and the options, the figure is released once saved
+    count('cache_misses', cache='chart')
+    fig = Figure(figsize=options['figsize'])
+    _draw(fig.subplots(), kind, series, options)
+    image = io.BytesIO()
+    fig.savefig(image, **SAVEFIG_OPTIONS)
+    fig.clear()
+    png = Image.open(image)
+    if png.width > MAX_IMAGE_WIDTH:
+        image = io.BytesIO()
+        png.resize((MAX_IMAGE_WIDTH, int(png.height * MAX_IMAGE_WIDTH / png.width)), resample=Image.BILINEAR).save(image, format='PNG')
+    return image.getvalue()
+
+
+def _vega_values(index):
+    return index.to_timestamp() if isinstance(index, pd.PeriodIndex) else index
+
+
+def vega_spec(kind, series, options):
+    # (data, spec) of the same chart for st.vega_lite_chart
+    if kind == 'hist':
+        return _vega_hist_spec(series, options)
+    if kind == 'heatmap':
+        return _vega_heatmap_spec(series, options)
+    if isinstance(series, pd.DataFrame):
+        # one line per column
+        data = series.set_axis(_vega_values(series.index)).rename_axis('x').reset_index().melt('x', var_name='series', value_name='y')
+    else:
+        data = pd.DataFrame({'x': _vega_values(series.index), 'y': series.to_numpy()})
+    color = to_hex(options.get('color') or 'C0')
+    spec = {'title': options['title'], 'width': 'container', 'height': round(options['figsize'][1] * VEGA_PIXELS_PER_INCH)}
+    if kind == 'pie':
+        spec.update(mark={'type': 'arc', 'tooltip': True},
+                    encoding={'theta': {'field': 'y', 'type': 'quantitative', 'stack': True},
+                              'color': {'field': 'x', 'type': 'nominal', 'title': None, 'sort': None}})
+        return data, spec
+    if isinstance(series.index, pd.PeriodIndex):
+        x_type = 'temporal'
+    else:
+        x_type = 'quantitative' if kind == 'line' and pd.api.types.is_numeric_dtype(series.index) else 'nominal'
+    x = {'field': 'x', 'type': x_type, 'title': options.get('xlabel'), 'sort': None}
+    y = {'field': 'y', 'type': 'quantitative', 'title': options.get('ylabel')}
+    if kind == 'line':
+        y['scale'] = {'zero': False}
+        layers = [{'mark': {'type': 'line', 'color': color, 'tooltip': True}, 'encoding': {'x': x, 'y': y}}]
+        if isinstance(series, pd.DataFrame):
+            layers[0]['mark'].pop('color')
+            layers[0]['encoding']['color'] = {'field': 'series', 'type': 'nominal', 'title': options.get('legend'), 'sort': list(series.columns)}
+        density = options.get('density')
+        if density is not None:
+            months, edges, counts = density
+            bands = pd.DataFrame({'x': pd.PeriodIndex.from_ordinals(months, freq='M').strftime('%Y-%m-01')})
+            for i, (low, high, opacity) in enumerate(DENSITY_BANDS):
+                bands[f'low{i}'], bands[f'high{i}'] = density_quantiles(edges, counts, low), density_quantiles(edges, counts, high)
+                layers.insert(i, {'data': {'values': bands.dropna().to_dict('records')},
+                                  'mark': {'type': 'area', 'color': 'lightblue', 'opacity': opacity},
+                                  'encoding': {'x': x, 'y': {**y, 'field': f'low{i}'}, 'y2': {'field': f'high{i}'}}})
+        spec['layer'] = layers
+    elif kind == 'barh':
+        # the labels are the other way round on a horizontal chart, and the first bar is at the bottom as matplotlib
+        # draws it
+        value = {**y, 'title': options.get('xlabel')}
+        if 'xlim' in options:
+            value['scale'] = {'domain': [float(limit) for limit in options['xlim']]}
+        spec.update(mark={'type': 'bar', 'color': color, 'clip': True, 'tooltip': True},
+                    encoding={'y': {**x, 'title': options.get('ylabel'), 'sort': [str(label) for label in data['x'][::-1]]}, 'x': value})
+    else:
+        spec.update(mark={'type': 'bar', 'color': color, 'tooltip': True}, encoding={'x': x, 'y': y})
+    return data, spec
+
+
+def _vega_hist_spec(frame, options):
+    bars = frame.rename_axis('x').reset_index().melt('x', var_name='series', value_name='y')
+    bars['x2'] = bars['x'] + options['bin_width']
+    color = {'field': 'series', 'type': 'nominal', 'title': options.get('legend'), 'sort': list(frame.columns)}
+    x = {'field': 'x', 'type': 'quantitative', 'title': options.get('xlabel')}
+    y = {'field': 'y', 'type': 'quantitative', 'title': options.get('ylabel'), 'stack': None}
+    layers = [{'mark': {'type': 'bar', 'opacity': 0.4, 'tooltip': True},
+               'encoding': {'x': x, 'x2': {'field': 'x2'}, 'y': y, 'color': color}}]
+    kde = options.get('kde')
+    if kde is not None:
+        curves = kde.rename_axis('x').reset_index().melt('x', var_name='series', value_name='y').dropna()
+        layers.append({'data': {'values': curves.to_dict('records')}, 'mark': 'line', 'encoding': {'x': x, 'y': y, 'color': color}})
+    spec = {'title': options['title'], 'width': 'container', 'height': round(options['figsize'][1] * VEGA_PIXELS_PER_INCH),
+            'layer': layers}
+    return bars, spec
+
+
+def _vega_heatmap_spec(frame, options):
+    cells = frame.rename_axis(index='y', columns='x').stack().rename('value').reset_index()
+    spec = {'title': options['title'], 'width': 'container', 'height': round(options['figsize'][1] * VEGA_PIXELS_PER_INCH),
+            'mark': {'type': 'rect', 'tooltip': True},
+            'encoding': {'x': {'field': 'x', 'type': 'ordinal', 'title': options.get('xlabel')},
+                         'y': {'field': 'y', 'type': 'ordinal', 'title': options.get('ylabel'), 'sort': 'descending'},
+                         'color': {'field': 'value', 'type': 'quantitative', 'title': options.get('legend'),
+                                   'scale': {'scheme': options.get('cmap') or 'viridis'}}}}
+    return cells, spec
+
+
+def show_chart(kind, series, backend=BACKENDS[0], **options):
+    # kind is 'line', 'bar', 'barh' or 'pie' as in Series.plot. options: title, xlabel, ylabel, color, figsize, xlim,
+    # rotation of the x tick labels, and density, the (months, bin edges, counts) of the transactions under a line.
+    # A 'line' chart of a frame draws one line per column, titled by the legend option. kind 'hist' takes a frame of
+    # counts per bin (indexed by lower edge, one column per series) and options bin_width, legend and kde, a frame of
+    # curves on a common x index. kind 'heatmap' takes a frame of values with the index along y and the columns along
+    # x, and options legend (the colour bar's title) and cmap
+    options.setdefault('figsize', (10, 5.8))
+    with span(f'chart {kind}'):
+        if backend == 'vega-lite':
+            data, spec = vega_spec(kind, series, options)
+            st.vega_lite_chart(data, spec)
+        else:
+            count('cache_requests', cache='chart')
+            st.image(render_png(kind, series, options))
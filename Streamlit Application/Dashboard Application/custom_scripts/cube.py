@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+from custom_scripts.instrument import count, span
+
+LEASE_SEGMENT_WIDTH = 5
+
+# resolution of the price histograms kept per (town, flat_type, year), fine enough for medians
+# and an exact divisor of the compare page bin widths
+SKETCH_BIN_WIDTH = {
+    'monthly_rent': 25,
+    'resale_price': 1000,
+}
+
+# price resolution of the transactions per month behind the trend pages' overlay, a few pixels of the chart
+DENSITY_BIN_WIDTH = {
+    'monthly_rent': 50,
+    'resale_price': 5000,
+}
+
+
+def lease_segments(remaining_lease):
+    # same segments as pd.cut(bins=range(0, 105, 5)): (0, 5] -> 0, (5, 10] -> 1, ..., -1 when out of range
+    segments = (remaining_lease.astype('int16') - 1) // LEASE_SEGMENT_WIDTH
+    return segments.where((remaining_lease > 0) & (remaining_lease <= 100), -1).astype('int8')
+
+
+def lease_segment_labels(segments):
+    return [f'{LEASE_SEGMENT_WIDTH * s}-{LEASE_SEGMENT_WIDTH * s + LEASE_SEGMENT_WIDTH - 1}' for s in segments]
+
+
+def build_cube(df, month_col, metric):
+    keys = ['town', month_col, 'flat_type']
+    values = df[metric].astype('float64')
+    frame = df[keys].assign(value=values, square=values ** 2)
+    if 'remaining_lease' in df.columns:
+        frame['lease_segment'] = lease_segments(df['remaining_lease'])
+        keys.append('lease_segment')
+
+    grouped = frame.groupby(keys, observed=True)
+    cells = grouped['value'].agg(['count', 'sum', 'min', 'max'])
+    cells['sumsq'] = grouped['square'].sum()
+    cells = cells.reset_index().astype({'count': 'int32', 'min': 'float32', 'max': 'float32'})
+
+    sketch = pd.DataFrame({
+        'town': df['town'],
+        'flat_type': df['flat_type'],
+        'year': (1970 + df[month_col] // 12).astype('int16'),
+        'bin': (values // SKETCH_BIN_WIDTH[metric]).astype('int32'),
+    })
+    sketch = sketch.groupby(list(sketch.columns), observed=True).size().rename('count').astype('int32').reset_index()
+    return cells, sketch
+
+
+def build_density(df, month_col, metric):
+    # transactions per (month, flat_type, price bin)
+    density = pd.DataFrame({
+        month_col: df[month_col],
+        'flat_type': df['flat_type'],
+        'bin': (df[metric].astype('float64') // DENSITY_BIN_WIDTH[metric]).astype('int32'),
+    })
+    return density.groupby(list(density.columns), observed=True).size().rename('count').astype('int32').reset_index()
+
+
+def merge_cells(cells, more):
+    # the cells of two sets of transactions combined, as build_cube would compute them over both
+    keys = [col for col in cells.columns if col not in ('count', 'sum', 'min', 'max', 'sumsq')]
+    grouped = pd.concat([cells, more], ignore_index=True).groupby(keys, observed=True, sort=False)
+    merged = grouped[['count', 'sum', 'sumsq']].sum()
+    merged['min'] = grouped['min'].min()
+    merged['max'] = grouped['max'].max()
+    return merged.reset_index()[cells.columns].astype({'count': 'int32', 'min': 'float32', 'max': 'float32'})
+
+
+def merge_counts(counts, more):
+    # sketch or density counts of two sets of transactions combined
+    keys = [col for col in counts.columns if col != 'count']
+    grouped = pd.concat([counts, more], ignore_index=True).groupby(keys, observed=True, sort=False)
+    return grouped['count'].sum().astype('int32').reset_index()
+
+
+def slice_cells(cells, month_col, flat_types, start, end):
+    count('cells_scanned', len(cells))
+    with span('slice cells'):
+        months = cells[month_col]
+        return cells[cells['flat_type'].isin(flat_types) & (months >= start) & (months <= end)]
+
+
+def rollup(cells, by):
+    with span('rollup'):
+        return _rollup(cells, by)
+
+
+def _rollup(cells, by):
+    grouped = cells.groupby(by, observed=True)
+    totals = grouped[['count', 'sum', 'sumsq']].sum()
+    totals['min'] = grouped['min'].min()
+    totals['max'] = grouped['max'].max()
+    totals['mean'] = totals['sum'] / totals['count']
+    # sample variance from the running moments, to match pandas' std()
+    variance = (totals['sumsq'] - totals['sum'] ** 2 / totals['count']) / (totals['count'] - 1)
+    totals['std'] = np.sqrt(variance.clip(lower=0))
+    return totals
+
+
+def sketch_histogram(sketch):
+    return sketch.groupby('bin')['count'].sum().sort_index()
+
+
+def sketch_quantile(histogram, metric, q):
+    # interpolate within the bin that holds the q-th observation
+    counts = histogram.to_numpy()
+    cumulative = np.cumsum(counts)
+    target = q * cumulative[-1]
+    i = min(np.searchsorted(cumulative, target), len(counts) - 1)
+    before = cumulative[i] - counts[i]
+    fraction = (target - before) / counts[i] if counts[i] else 0.5
+    return (histogram.index[i] + fraction) * SKETCH_BIN_WIDTH[metric]
+
+
+def sketch_rebin(histogram, metric, width):
+    # counts per bin of width, a multiple of the sketch's bin width, indexed by each bin's lower edge
+    factor = width // SKETCH_BIN_WIDTH[metric]
+    rebinned = histogram.groupby(histogram.index // factor).sum()
+    rebinned.index = rebinned.index * width
+    return rebinned
+
+
+def binned_kde(histogram, metric, bandwidth, cut=0):
+    # Gaussian KDE of the sketched values, each bin's count at its centre and the kernel convolved along the sketch's
+    # regular grid, evaluated up to cut bandwidths past the outermost bins (0 as in histplot(kde=True)). (x, density),
+    # the density integrating to 1, empty without a finite bandwidth (fewer than two values)
+    width = SKETCH_BIN_WIDTH[metric]
+    if not np.isfinite(bandwidth):
+        return np.empty(0), np.empty(0)
+    bandwidth = max(bandwidth, width)
+    reach = int(np.ceil(3 * bandwidth / width))
+    bins = np.arange(histogram.index.min() - reach, histogram.index.max() + reach + 1)
+    counts = histogram.reindex(bins, fill_value=0).to_numpy(dtype=float)
+    kernel = np.exp(-0.5 * (np.arange(-reach, reach + 1) * width / bandwidth) ** 2)
+    density = np.convolve(counts, kernel, mode='same') / (counts.sum() * bandwidth * np.sqrt(2 * np.pi))
+    x = (bins + 0.5) * width
+    keep = (x >= histogram.index.min() * width - cut * bandwidth) & (x <= (histogram.index.max() + 1) * width + cut * bandwidth)
+    return x[keep], density[keep]
+
+
+def scott_bandwidth(count, std):
+    # scipy's gaussian_kde default, which seaborn's kdeplot uses
+    return std * count ** -0.2
+
+
+def density_grid(density, month_col, metric):
+    # (months, bin edges, counts) of a sliced density summed over flat types, counts of shape (bins, months); None
+    # when nothing is left
+    if density.empty:
+        return None
+    months = np.arange(density[month_col].min(), density[month_col].max() + 1)
+    bins = np.arange(density['bin'].min(), density['bin'].max() + 2)
+    counts = np.zeros((len(bins) - 1, len(months)), dtype=np.int64)
+    np.add.at(counts, (density['bin'].to_numpy() - bins[0], density[month_col].to_numpy() - months[0]), density['count'].to_numpy())
+    return months, bins * DENSITY_BIN_WIDTH[metric], counts
+
+
+def density_quantiles(edges, counts, q):
+    # per month, the value below which a fraction q of the transactions fall, interpolated within the bin as
+    # sketch_quantile does; NaN for months without transactions
+    cumulative = np.cumsum(counts, axis=0)
+    target = q * cumulative[-1]
+    i = np.minimum((cumulative < target).sum(axis=0), len(counts) - 1)
+    columns = np.arange(counts.shape[1])
+    before = cumulative[i, columns] - counts[i, columns]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(counts[i, columns] > 0, (target - before) / counts[i, columns], 0.5)
+    values = edges[i] + fraction * (edges[1] - edges[0])
+    return np.where(cumulative[-1] > 0, values, np.nan)
@@ -0,0 +1,359 @@
+import calendar
+import contextlib
+import glob
+import os
+import shutil
+import threading
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from custom_scripts.cube import build_cube, build_density, merge_cells, merge_counts
+from custom_scripts.instrument import count, span
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: ingests are only serialised within a process
+    fcntl = None
+
+DATA_DIR = 'data'
+STORE_DIR = os.path.join(DATA_DIR, 'store')
+
+# every resale period file (1990-1999, 2000-2011, ...) is ingested into one dataset
+SOURCES = {
+    'rental': 'RentingOutOfFlats.csv',
+    'resale': 'ResaleFlatPrices*.csv',
+}
+
+MONTH_COLUMNS = {
+    'rental': 'rent_approval_date',
+    'resale': 'month',
+}
+
+METRICS = {
+    'rental': 'monthly_rent',
+    'resale': 'resale_price',
+}
+
+CATEGORICAL_COLUMNS = ['town', 'flat_type', 'flat_model', 'storey_range', 'block', 'street_name']
+
+DTYPES = {
+    'floor_area_sqm': 'float32',
+    'lease_commence_date': 'int16',
+    'resale_price': 'float32',
+    'monthly_rent': 'int32',
+}
+
+# rows read from a source csv at a time
+CHUNK_ROWS = 200_000
+
+MONTH_ABBR = list(calendar.month_abbr)[1:]
+
+
+def month_ordinal(date):
+    # months since Jan 1970, i.e. the ordinal of a monthly pd.Period
+    return pd.Period(date, freq='M').ordinal
+
+
+def month_start(ordinal):
+    return dt(year=ordinal_year(ordinal), month=ordinal % 12 + 1, day=1)
+
+
+def ordinal_year(ordinal):
+    return 1970 + ordinal // 12
+
+
+def to_period_index(ordinals):
+    return pd.PeriodIndex.from_ordinals(ordinals, freq='M')
+
+
+def store_path(name):
+    # a directory of Parquet files partitioned by year=YYYY
+    return os.path.join(STORE_DIR, name)
+
+
+def cube_paths(name):
+    return os.path.join(STORE_DIR, f'{name}.cube.parquet'), os.path.join(STORE_DIR, f'{name}.sketch.parquet')
+
+
+def density_path(name):
+    return os.path.join(STORE_DIR, f'{name}.density.parquet')
+
+
+def source_paths(name):
+    return sorted(glob.glob(os.path.join(DATA_DIR, SOURCES[name])))
+
+
+def _month_ordinals(months):
+    # the 'YYYY-MM' categories are parsed once each and mapped back through the codes
+    parsed = pd.to_datetime(months.cat.categories)
+    ordinals = ((parsed.year - 1970) * 12 + parsed.month - 1).to_numpy()
+    return pd.Series(ordinals[months.cat.codes], index=months.index, dtype='int16')
+
+
+def read_chunks(name):
+    # the source csvs CHUNK_ROWS rows at a time, read straight into compact dtypes: the text columns as categoricals
+    # (blocks such as 123A stay text even when a chunk only has numeric ones), prices as float32/int32, months as
+    # int16 ordinals. The 2019+ resale files carry remaining_lease as text, it is derived for every period instead.
+    # Every chunk's categoricals share the categories seen so far, so chunks concatenate and group without decoding
+    month_col = MONTH_COLUMNS[name]
+    dtypes = {month_col: 'category', **{col: 'category' for col in CATEGORICAL_COLUMNS}, **DTYPES}
+    columns, categories = None, {}
+    for path in source_paths(name):
+        with pd.read_csv(path, dtype=dtypes, usecols=lambda col: col != 'remaining_lease', chunksize=CHUNK_ROWS) as reader:
+            for chunk in reader:
+                # the period files share their columns, in the order of the first one
+                columns = list(chunk.columns) if columns is None else columns
+                chunk = chunk[columns]
+                chunk[month_col] = _month_ordinals(chunk[month_col])
+                for col in CATEGORICAL_COLUMNS:
+                    if col in chunk.columns:
+                        known = categories.get(col, chunk[col].cat.categories)
+                        categories[col] = known.append(chunk[col].cat.categories.difference(known))
+                        chunk[col] = chunk[col].cat.set_categories(categories[col])
+                if name == 'resale':
+                    chunk['remaining_lease'] = (99 + chunk['lease_commence_date'] - ordinal_year(chunk['month'])).astype('int16')
+                yield chunk
+
+
+def drop_seen(chunk, years, seen):
+    # drops the rows already ingested, or repeated within the chunk, by their 64-bit row hash. Identical rows share a
+    # month, so seen holds the sorted hashes of the rows kept so far per year: 8 bytes a row, where drop_duplicates()
+    # needs the whole frame at once, and a chunk is only looked up in and merged into the years it holds
+    hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    new = ~pd.Series(hashes).duplicated().to_numpy()
+    for year in pd.unique(years):
+        rows = years == year
+        known = seen.get(year, np.empty(0, dtype=np.uint64))
+        if len(known):
+            positions = np.searchsorted(known, hashes[rows]).clip(max=len(known) - 1)
+            new[rows] &= known[positions] != hashes[rows]
+        # two sorted runs, which the stable sort merges in linear time
+        seen[year] = np.concatenate([known, np.sort(hashes[rows & new])])
+        seen[year].sort(kind='stable')
+    return chunk[new], years[new]
+
+
+def _arrow_schema(rows):
+    # categoricals as dictionaries with int32 indices, so chunks with different numbers of categories share a schema
+    schema = pa.Schema.from_pandas(rows, preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_dictionary(field.type):
+            schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type)))
+    return schema
+
+
+def _write_year(path, year, rows, writers):
+    # appends to the one Parquet file of the year=YYYY directory, a row group per chunk
+    if year not in writers:
+        os.makedirs(os.path.join(path, f'year={year}'))
+        writers[year] = pq.ParquetWriter(os.path.join(path, f'year={year}', 'part-0.parquet'), _arrow_schema(rows))
+    writers[year].write_table(pa.Table.from_pandas(rows, schema=writers[year].schema, preserve_index=False))
+
+
+def _sort_year(path, month_col):
+    # the period files are in month order already, a year is only rewritten when its rows are not
+    months = pq.read_table(path, columns=[month_col])[month_col].to_numpy()
+    if not (months[1:] >= months[:-1]).all():
+        table = pq.read_table(path)
+        pq.write_table(table.take(np.argsort(months, kind='stable')), path)
+
+
+def _merge_pair(merge, earlier, later):
+    # the earlier frame's categoricals are brought up to the later one's (the categories only ever grow) so the two
+    # concatenate without decoding
+    dtypes = {col: dtype for col, dtype in later.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+    return merge(earlier.astype(dtypes), later)
+
+
+def _push(stack, frame, merge):
+    # adds a chunk's aggregate to a stack of partial aggregates, merging the top two while the newer is at least half
+    # the size of the older: each cell is merged a logarithmic number of times, and the partials stay within a small
+    # multiple of the final aggregate
+    stack.append(frame)
+    while len(stack) > 1 and 2 * len(stack[-1]) >= len(stack[-2]):
+        later = stack.pop()
+        stack[-1] = _merge_pair(merge, stack[-1], later)
+
+
+def _reduce(stack, merge):
+    # the aggregate of every chunk, keyed and sorted like a single build_cube over every row
+    while len(stack) > 1:
+        later = stack.pop()
+        stack[-1] = _merge_pair(merge, stack[-1], later)
+    frame = stack[0]
+    frame = frame.astype({col: pd.CategoricalDtype(sorted(frame[col].cat.categories)) for col in CATEGORICAL_COLUMNS if col in frame.columns})
+    keys = [col for col in frame.columns if col not in ('count', 'sum', 'min', 'max', 'sumsq')]
+    return frame.sort_values(keys).reset_index(drop=True)
+
+
+# held by the ingest in progress, see _exclusive
+_ingest_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _exclusive(name):
+    # one ingest at a time: across the sessions and cache loaders of this process with a lock, and across processes
+    # (the prediction service, the scripts) with an flock on a file next to the store
+    with _ingest_lock:
+        os.makedirs(STORE_DIR, exist_ok=True)
+        with open(store_path(name) + '.lock', 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def ingest(name):
+    with _exclusive(name):
+        _ingest(name)
+
+
+def _ingest(name):
+    # streams the sources into the store chunk by chunk: memory stays at about one chunk, the row hashes and the
+    # aggregates however long the history grows
+    month_col, metric = MONTH_COLUMNS[name], METRICS[name]
+    os.makedirs(STORE_DIR, exist_ok=True)
+    # write aside then swap so concurrent readers never see a half written store
+    path = store_path(name)
+    shutil.rmtree(path + '.tmp', ignore_errors=True)
+    os.makedirs(path + '.tmp')
+    seen, writers = {}, {}
+    cells, sketch, density = [], [], []
+    try:
+        for chunk in read_chunks(name):
+            chunk, years = drop_seen(chunk, ordinal_year(chunk[month_col]).to_numpy(), seen)
+            count('rows_ingested', len(chunk), source=name)
+            for year, rows in chunk.groupby(years, sort=False):
+                _write_year(path + '.tmp', year, rows, writers)
+            chunk_cells, chunk_sketch = build_cube(chunk, month_col, metric)
+            _push(cells, chunk_cells, merge_cells)
+            _push(sketch, chunk_sketch, merge_counts)
+            _push(density, build_density(chunk, month_col, metric), merge_counts)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    for year in writers:
+        _sort_year(os.path.join(path + '.tmp', f'year={year}', 'part-0.parquet'), month_col)
+    if os.path.exists(path):
+        os.replace(path, path + '.old')
+    os.replace(path + '.tmp', path)
+    shutil.rmtree(path + '.old', ignore_errors=True)
+
+    # the cube is written last, its mtime marks the whole store as fresh
+    cube_path, sketch_path = cube_paths(name)
+    for stack, merge, path in [(sketch, merge_counts, sketch_path), (density, merge_counts, density_path(name)), (cells, merge_cells, cube_path)]:
+        _reduce(stack, merge).to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+
+def _is_fresh(name, source_mtime):
+    cube_path = cube_paths(name)[0]
+    return all(os.path.exists(p) for p in [store_path(name), *cube_paths(name), density_path(name)]) and os.path.getmtime(cube_path) >= source_mtime
+
+
+def _ensure_ingested(name, source_mtime):
+    if _is_fresh(name, source_mtime):
+        return
+    with _exclusive(name):
+        # another session or process may have ingested while this one waited for the lock
+        if not _is_fresh(name, source_mtime):
+            _ingest(name)
+
+
+def refresh(name):
+    # re-ingest if a source csv changed, for scripts reading the store without going through the cache
+    _ensure_ingested(name, _source_mtime(name))
+
+
+@st.cache_resource(show_spinner='Loading transaction data...', max_entries=len(SOURCES))
+def _load_transactions(name, source_mtime):
+    count('cache_misses', cache='transactions', source=name)
+    _ensure_ingested(name, source_mtime)
+    with span('read transactions'):
+        return pd.read_parquet(store_path(name)).drop(columns='year')
+
+
+@st.cache_resource(show_spinner='Loading transaction data...', max_entries=len(SOURCES))
+def _load_cube(name, source_mtime):
+    count('cache_misses', cache='cube', source=name)
+    _ensure_ingested(name, source_mtime)
+    cube_path, sketch_path = cube_paths(name)
+    with span('read cube'):
+        return pd.read_parquet(cube_path), pd.read_parquet(sketch_path)
+
+
+@st.cache_resource(show_spinner='Loading transaction data...', max_entries=len(SOURCES))
+def _load_density(name, source_mtime):
+    count('cache_misses', cache='density', source=name)
+    _ensure_ingested(name, source_mtime)
+    with span('read density'):
+        return pd.read_parquet(density_path(name))
+
+
+def _source_mtime(name):
+    return max([os.path.getmtime(path) for path in source_paths(name)], default=0)
+
+
+def load_dataset(name):
+    # every transaction, for scripts; the pages read the cube and density aggregates instead. The read is cached
+    # and keyed on the source mtime so a refreshed csv is re-ingested without restarting the app; the returned
+    # frame may be shared across sessions, do not modify it in place
+    with span('load transactions'):
+        count('cache_requests', cache='transactions', source=name)
+        df = _load_transactions(name, _source_mtime(name))
+        count('rows_scanned', len(df), source=name)
+    return df
+
+
+def load_cube(name):
+    # (cells, sketch) pre-aggregated at ingest time, see custom_scripts.cube
+    count('cache_requests', cache='cube', source=name)
+    with span('load cube'):
+        return _load_cube(name, _source_mtime(name))
+
+
+def load_density(name):
+    # transactions per (month, flat_type, price bin), see custom_scripts.cube.build_density
+    count('cache_requests', cache='density', source=name)
+    with span('load density'):
+        return _load_density(name, _source_mtime(name))
+
+
+def month_range(name):
+    months = load_cube(name)[0][MONTH_COLUMNS[name]]
+    return int(months.min()), int(months.max())
+
+
+def load_rental():
+    return load_dataset('rental')
+
+
+def load_resale():
+    return load_dataset('resale')
+
+
+def load_rental_cube():
+    return load_cube('rental')
+
+
+def load_resale_cube():
+    return load_cube('resale')
+
+
+def load_rental_density():
+    return load_density('rental')
+
+
+def load_resale_density():
+    return load_density('resale')
+
+
+if __name__ == '__main__':
+    for name in SOURCES:
+        ingest(name)
+        print(f"{', '.join(source_paths(name))} -> {store_path(name)}")
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_scripts.datastore import MONTH_COLUMNS, SOURCES, STORE_DIR
+from custom_scripts.pipeline import load_features, watermark_path
+from custom_scripts.prediction import AMENITY_COLUMNS, CPI_PATH, RENTAL_COLUMNS, RESALE_COLUMNS, RentalEncoder, ResaleEncoder
+
+# The encoded model inputs, materialised once per feature table update. The matrix is float32 (the precision the tree
+# models and XGBoost split on anyway) in a .npy file that training and every cross-validation fold memory-map and
+# index into, with a manifest recording its columns, row count and a hash of its content. It is rebuilt when the
+# feature table's watermark is newer than the manifest. Build it ahead of a training run from the dashboard directory:
+#   python -m custom_scripts.feature_store
+
+# the notebooks train on 2012 onwards for resale and on the whole rental dataset
+FIRST_YEAR = {'resale': 2012, 'rental': None}
+TARGETS = {'resale': 'real_resale_price', 'rental': 'monthly_rent'}
+EXCLUDED_FLAT_TYPES = {'resale': ['MULTI-GENERATION', '1 ROOM'], 'rental': ['1-ROOM']}
+COLUMNS = {'resale': RESALE_COLUMNS, 'rental': RENTAL_COLUMNS}
+
+# rows encoded at a time, bounding the float64 scratch the encoders allocate
+CHUNK_ROWS = 100_000
+
+
+def matrix_dir(name):
+    return os.path.join(STORE_DIR, f'{name}.matrix')
+
+
+def manifest_path(name):
+    return os.path.join(matrix_dir(name), 'manifest.json')
+
+
+def prepare_listings(name, df):
+    # feature table rows as the listings the encoders take, the categorical columns passed as they are (the encoders
+    # parse storey_range, flat_type and flat_model per category, see custom_scripts.transforms)
+    months = df[MONTH_COLUMNS[name]].to_numpy()
+    listings = df[[c for c in ['town', 'street_name', 'flat_type', 'flat_model', 'storey_range', 'floor_area_sqm',
+                               'lease_commence_date'] if c in df.columns]]
+    return listings.assign(year=1970 + months // 12, month=months % 12 + 1)
+
+
+def training_rows(name):
+    df = load_features(name)
+    if FIRST_YEAR[name] is not None:
+        df = df[df[MONTH_COLUMNS[name]] >= (FIRST_YEAR[name] - 1970) * 12]
+    return df[~df['flat_type'].isin(EXCLUDED_FLAT_TYPES[name]) & df[TARGETS[name]].notna()].reset_index(drop=True)
+
+
+def materialize(name):
+    # encodes the training rows chunk by chunk straight into the memory-mapped matrix, amenity distances taken per
+    # block as in the notebooks; rows the encoder cannot encode are skipped
+    df = training_rows(name)
+    streets = df[['town', 'street_name', *AMENITY_COLUMNS]].drop_duplicates(['town', 'street_name']).astype({'town': str, 'street_name': str})
+    encoder = ResaleEncoder(streets, pd.read_csv(CPI_PATH)) if name == 'resale' else RentalEncoder(streets)
+    directory = matrix_dir(name)
+    os.makedirs(directory, exist_ok=True)
+    X = np.lib.format.open_memmap(os.path.join(directory, 'X.npy.tmp'), mode='w+', dtype=np.float32, shape=(len(df), len(encoder.columns)))
+    y = np.empty(len(df))
+    digest = hashlib.sha1()
+    rows = 0
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        features, valid = encoder.encode(prepare_listings(name, chunk))
+        features[:, encoder.amenity_columns] = chunk[AMENITY_COLUMNS].to_numpy(dtype=float)
+        n = int(valid.sum())
+        X[rows:rows + n] = features[valid]
+        y[rows:rows + n] = chunk[TARGETS[name]].to_numpy(dtype=float)[valid]
+        digest.update(X[rows:rows + n].tobytes())
+        rows += n
+    digest.update(y[:rows].tobytes())
+    X.flush()
+    del X
+    np.save(os.path.join(directory, 'y.npy.tmp.npy'), y[:rows])
+    os.replace(os.path.join(directory, 'X.npy.tmp'), os.path.join(directory, 'X.npy'))
+    os.replace(os.path.join(directory, 'y.npy.tmp.npy'), os.path.join(directory, 'y.npy'))
+    manifest = {'columns': list(encoder.columns), 'rows': rows, 'skipped': len(df) - rows, 'dtype': 'float32',
+                'target': TARGETS[name], 'fingerprint': digest.hexdigest()[:16], 'built': time.time()}
+    # written last, its mtime marks the matrix as fresh
+    with open(manifest_path(name) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path(name) + '.tmp', manifest_path(name))
+    return manifest
+
+
+def load_matrix(name):
+    # (X, y, manifest): X is a read-only memory map of the first manifest['rows'] rows, rebuilt first if stale
+    source_mtime = os.path.getmtime(watermark_path(name)) if os.path.exists(watermark_path(name)) else 0
+    if not os.path.exists(manifest_path(name)) or os.path.getmtime(manifest_path(name)) < source_mtime:
+        materialize(name)
+    with open(manifest_path(name)) as f:
+        manifest = json.load(f)
+    X = np.load(os.path.join(matrix_dir(name), 'X.npy'), mmap_mode='r')[:manifest['rows']]
+    y = np.load(os.path.join(matrix_dir(name), 'y.npy'), mmap_mode='r')
+    return X, y, manifest
+
+
+if __name__ == '__main__':
+    for name in SOURCES:
+        start = time.perf_counter()
+        manifest = materialize(name)
+        print(f"{name}: {manifest['rows']} x {len(manifest['columns'])} float32 matrix ({manifest['skipped']} rows skipped) "
+              f"-> {matrix_dir(name)} in {time.perf_counter() - start:.1f}s")
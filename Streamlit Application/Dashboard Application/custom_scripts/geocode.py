@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from custom_scripts.datastore import SOURCES, STORE_DIR, refresh, store_path
+
+# Block-level coordinates for (block, street_name) addresses. The zipcode mapper is normalised once into a Parquet
+# cache where the row number is the address id; lookups go through a hash index on the normalised pair and return
+# those integer ids, so a dataset is geocoded by looking up its distinct addresses and broadcasting ids rather than
+# merging strings across every row. Run from the dashboard directory to list the addresses without coordinates:
+#   python -m custom_scripts.geocode
+
+# the notebooks' zipcode mapper, read where it is in the repository rather than from a copy
+ZIPCODE_MAPPER_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'ML Predictions', 'Source code',
+                                                    'sg_zipcode_mapper_utf.csv'))
+GEOCODE_STORE = os.path.join(STORE_DIR, 'geocode.parquet')
+
+
+def normalise(values):
+    # upper case with single spaces, the form data.gov.sg uses
+    return pd.Series(values, dtype=str).str.upper().str.split().str.join(' ')
+
+
+class Geocoder:
+    def __init__(self, addresses):
+        # addresses: block, street_name, lat, lng with one row per normalised address, the row number being its id
+        self.addresses = addresses
+        self.index = pd.MultiIndex.from_arrays([addresses['block'], addresses['street_name']])
+        self.coordinates = addresses[['lat', 'lng']].to_numpy()
+
+    def lookup(self, blocks, streets):
+        # address id of every (block, street_name), -1 where there are no coordinates. Each distinct pair is
+        # normalised and hashed once
+        blocks, streets = pd.Categorical(blocks), pd.Categorical(streets)
+        keys = blocks.codes.astype(np.int64) * (len(streets.categories) + 1) + streets.codes
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        pairs = pd.MultiIndex.from_arrays([normalise(np.asarray(blocks[first])), normalise(np.asarray(streets[first]))])
+        return self.index.get_indexer(pairs).astype(np.int32)[inverse.ravel()]
+
+    def misses(self, blocks, streets):
+        # the addresses lookup finds no coordinates for, with their number of rows, most frequent first
+        ids = self.lookup(blocks, streets)
+        missed = pd.DataFrame({'block': np.asarray(blocks)[ids < 0], 'street_name': np.asarray(streets)[ids < 0]}, dtype=str)
+        return missed.value_counts().rename('rows').reset_index()
+
+
+def _source_mtime():
+    return os.path.getmtime(ZIPCODE_MAPPER_PATH) if os.path.exists(ZIPCODE_MAPPER_PATH) else 0
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_geocoder(source_mtime):
+    if not os.path.exists(GEOCODE_STORE) or os.path.getmtime(GEOCODE_STORE) < source_mtime:
+        mapper = pd.read_csv(ZIPCODE_MAPPER_PATH, usecols=['block', 'street_name', 'lat', 'lng'], dtype={'block': str})
+        mapper = mapper.dropna()
+        mapper['block'], mapper['street_name'] = normalise(mapper['block']).to_numpy(), normalise(mapper['street_name']).to_numpy()
+        # The mapper lists about a hundred addresses twice, so far always with the same coordinates. The notebooks'
+        # merge keeps every match and duplicates those transactions until their drop_duplicates() removes the
+        # identical copies; one row per address gives the same result directly. Keeping the first of two copies that
+        # disagree is a deliberate difference, the notebooks would keep the transaction once per coordinate
+        addresses = mapper.drop_duplicates(['block', 'street_name']).reset_index(drop=True)
+        os.makedirs(STORE_DIR, exist_ok=True)
+        addresses.to_parquet(GEOCODE_STORE + '.tmp', index=False)
+        os.replace(GEOCODE_STORE + '.tmp', GEOCODE_STORE)
+    return Geocoder(pd.read_parquet(GEOCODE_STORE))
+
+
+def load_geocoder():
+    # shared across sessions and rebuilt when the zipcode mapper changes
+    return _load_geocoder(_source_mtime())
+
+
+if __name__ == '__main__':
+    geocoder = load_geocoder()
+    for name in SOURCES:
+        refresh(name)
+        df = pd.read_parquet(store_path(name), columns=['block', 'street_name'])
+        misses = geocoder.misses(df['block'], df['street_name'])
+        path = os.path.join(STORE_DIR, f'{name}.geocode_misses.csv')
+        misses.to_csv(path, index=False)
+        print(f"{name}: {misses['rows'].sum()} of {len(df)} rows at {len(misses)} addresses without coordinates -> {path}")
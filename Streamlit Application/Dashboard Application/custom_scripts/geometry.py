@@ -0,0 +1,90 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+import streamlit as st
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+
+from custom_scripts.datastore import STORE_DIR
+
+# Planning-area boundaries shared by every page and session. The GeoJSON is parsed once and kept as GeoParquet
+# (WKB geometry, no GDAL on the read path); everything derived from it is cached per process and rebuilt when the
+# GeoJSON changes.
+
+BOUNDARIES_PATH = 'data/MasterPlan2019PlanningAreaBoundaryNoSea.geojson'
+BOUNDARIES_STORE = os.path.join(STORE_DIR, 'planning_areas.parquet')
+
+# ~20 m simplification and ~1 m coordinate precision, both well under a pixel at the zoom levels the maps are viewed at
+SIMPLIFY_TOLERANCE = 0.0002
+COORDINATE_PRECISION = 0.00001
+
+# SVY21, metres on the ground, for the static matplotlib maps
+PLOT_CRS = 'EPSG:3414'
+
+
+def _source_mtime():
+    return os.path.getmtime(BOUNDARIES_PATH) if os.path.exists(BOUNDARIES_PATH) else 0
+
+
+@st.cache_resource(show_spinner='Loading planning area boundaries...', max_entries=1)
+def _load_planning_areas(source_mtime):
+    if not os.path.exists(BOUNDARIES_STORE) or os.path.getmtime(BOUNDARIES_STORE) < source_mtime:
+        areas = gpd.read_file(BOUNDARIES_PATH)
+        areas['geometry'] = shapely.force_2d(areas.geometry.values)
+        os.makedirs(STORE_DIR, exist_ok=True)
+        areas.to_parquet(BOUNDARIES_STORE + '.tmp', index=False)
+        os.replace(BOUNDARIES_STORE + '.tmp', BOUNDARIES_STORE)
+    return gpd.read_parquet(BOUNDARIES_STORE)
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _planning_area_features(source_mtime):
+    areas = _load_planning_areas(source_mtime)
+    geometry = areas.geometry.simplify(SIMPLIFY_TOLERANCE, preserve_topology=True).values
+    geometry = shapely.set_precision(shapely.make_valid(geometry), COORDINATE_PRECISION)
+    return [{'type': 'Feature', 'geometry': shapely.geometry.mapping(shape), 'properties': {'PLN_AREA_N': name}}
+            for name, shape in zip(areas['PLN_AREA_N'], geometry)]
+
+
+def _ring_path(polygon):
+    rings = [polygon.exterior, *polygon.interiors]
+    return Path.make_compound_path(*[Path(np.asarray(ring.coords), closed=True) for ring in rings])
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _planning_area_paths(source_mtime):
+    areas = _load_planning_areas(source_mtime).to_crs(PLOT_CRS)
+    paths = {}
+    for name, shape in zip(areas['PLN_AREA_N'], areas.geometry):
+        polygons = shape.geoms if hasattr(shape, 'geoms') else [shape]
+        paths[name] = Path.make_compound_path(*[_ring_path(polygon) for polygon in polygons if polygon.geom_type == 'Polygon'])
+    return paths
+
+
+def load_planning_areas():
+    # GeoDataFrame with PLN_AREA_N and 2D geometry in EPSG:4326, shared across sessions, do not modify it in place
+    return _load_planning_areas(_source_mtime())
+
+
+def planning_area_features():
+    # simplified GeoJSON features carrying only the area name, ready to embed in a folium map
+    return _planning_area_features(_source_mtime())
+
+
+def planning_area_paths():
+    # {area name: matplotlib Path} projected to PLOT_CRS
+    return _planning_area_paths(_source_mtime())
+
+
+def plot_planning_areas(ax, highlight=None):
+    # every planning area in translucent blue with black edges, as GeoDataFrame.plot(alpha=0.5, edgecolor='k'),
+    # then the areas in highlight ({name: color}) filled on top
+    paths = planning_area_paths()
+    ax.add_collection(PathCollection(list(paths.values()), facecolor='C0', edgecolor='k', alpha=0.5))
+    for name, color in (highlight or {}).items():
+        if name in paths:
+            ax.add_collection(PathCollection([paths[name]], facecolor=color, edgecolor=color))
+    ax.autoscale_view()
+    ax.set_aspect('equal')
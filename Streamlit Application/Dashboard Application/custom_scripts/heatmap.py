@@ -1,6 +1,10 @@
 from branca.colormap import LinearColormap
 import numpy as np
 import folium
+import streamlit as st
+
+from custom_scripts.geometry import planning_area_features
+from custom_scripts.instrument import count, span
 
 METRIC_MAP = {
     'monthly_rent': 'Average Monthly Rent (SGD)',
@@ -8,19 +12,41 @@ METRIC_MAP = {
     'count': 'Number of transactions'
 }
 
-def heatmap(map_data, metric):
-    min_metric = map_data[metric].min()
-    max_metric = map_data[metric].max()
+COLORS = ['#FFFFE0', '#FFFF00', '#FFA500', '#FF4500']
+
+# same size folium_static gives a map
+MAP_WIDTH, MAP_HEIGHT = 700, 500
+
+
+def fill_colors(values, vmin, vmax):
+    # the LinearColormap gradient evaluated for every area at once
+    stops = np.linspace(vmin, vmax, len(COLORS))
+    rgb = np.array([[int(color[i:i + 2], 16) / 255 for i in (1, 3, 5)] for color in COLORS])
+    channels = np.column_stack([np.interp(np.nan_to_num(values, nan=vmin), stops, rgb[:, i]) for i in range(3)])
+    # truncated like branca's rgb_hex_str
+    return ['#{:02x}{:02x}{:02x}'.format(*channel) for channel in (channels * 255.9999).astype(int)]
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def heatmap_html(metric, values):
+    # values is a tuple of (planning area, value) pairs, so identical filter states hit the cache
+    count('cache_misses', cache='heatmap')
+    values = dict(values)
+    features = planning_area_features()
+    names = [feature['properties']['PLN_AREA_N'] for feature in features]
+    metric_values = np.array([values.get(name, np.nan) for name in names], dtype=float)
+    min_metric, max_metric = np.nanmin(metric_values), np.nanmax(metric_values)
     # Normalize 0-1 scale
-    def normalize_price(price): 
-        return 0 if np.isnan(price) else (price - min_metric) / (max_metric - min_metric)
-    
-    map_data['normalized_metric'] = map_data[metric].apply(normalize_price)
+    normalized = np.nan_to_num((metric_values - min_metric) / (max_metric - min_metric))
+    colors = fill_colors(metric_values, min_metric, max_metric)
+    known = ~np.isnan(metric_values)
+    styles = {name: {'fillColor': colors[i] if known[i] else 'lightgray', 'color': 'black',
+                     'fillOpacity': float(normalized[i]) if known[i] else 1, 'weight': 1} for i, name in enumerate(names)}
 
     colormap = LinearColormap(
         vmin=min_metric,
         vmax=max_metric,
-        colors=['#FFFFE0', '#FFFF00', '#FFA500', '#FF4500'],  # Shades
+        colors=COLORS,  # Shades
         caption=f'Normalized {METRIC_MAP[metric]}'
     )
 
@@ -49,18 +75,25 @@ def heatmap(map_data, metric):
 
     m = folium.Map(location=[1.3521, 103.8198], zoom_start=11, tiles="CartoDB positron") # centered in Singapore
 
-    g = folium.GeoJson(
-        map_data,
-        style_function=lambda x: {
-            "fillColor": colormap(x['properties'][metric]) if x['properties'][metric] is not None else "lightgray",
-            "color": "black",
-            "fillOpacity": x['properties']['normalized_metric'] if x['properties'][metric] is not None else 1,
-            'weight': 1
-        },
+    data = {'type': 'FeatureCollection', 'features': [
+        {**feature, 'properties': {'PLN_AREA_N': name, metric: float(value) if known[i] else None}}
+        for i, (feature, name, value) in enumerate(zip(features, names, metric_values))]}
+    folium.GeoJson(
+        data,
+        style_function=lambda x: styles[x['properties']['PLN_AREA_N']],
         tooltip=tooltip,
         popup=popup,
     ).add_to(m)
 
     colormap.add_to(m)
 
-    return m
\ No newline at end of file
+    return folium.Figure().add_child(m).render()
+
+
+def show_heatmap(values, metric):
+    # values is a Series of the metric indexed by town
+    count('cache_requests', cache='heatmap')
+    with span('heatmap'):
+        html = heatmap_html(metric, tuple(zip(values.index.astype(str), values.astype(float))))
+    # a sandboxed iframe as folium_static used, the map needs its scripts
+    st.iframe(html, width=MAP_WIDTH, height=MAP_HEIGHT + 10)
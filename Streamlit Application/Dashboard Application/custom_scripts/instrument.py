@@ -0,0 +1,174 @@
+import contextlib
+import io
+import logging
+import os
+import threading
+import time
+
+# Timing spans and counters for the hot paths, off unless HDB_INSTRUMENT=1 so it can stay in production code: while
+# disabled, span() hands back one shared do-nothing context manager and count() returns straight away.
+#
+#   with span('rollup'):              # timed, nested spans are indented in the debug panel
+#       ...
+#   count('rows_scanned', len(df), source='resale')
+#
+# A page calls start_rerun() first and finish_rerun() last. finish_rerun() logs the rerun's spans to the
+# 'hdb.instrument' logger, rewrites HDB_METRICS_FILE (Prometheus text format, for a node exporter's textfile
+# collector) when that is set, and shows the rerun's spans and the process's counters in a sidebar panel when the
+# page is opened with ?debug=1. HDB_PROFILE=cprofile (or pyinstrument, if installed) also profiles every rerun and
+# adds the report to the panel. The prediction service serves the same metrics on GET /metrics.
+
+ENABLED = os.environ.get('HDB_INSTRUMENT', '') not in ('', '0')
+PROFILER = os.environ.get('HDB_PROFILE', '') if ENABLED else ''
+METRICS_FILE = os.environ.get('HDB_METRICS_FILE', '')
+
+METRIC_PREFIX = 'hdb'
+
+# functions listed in a cProfile report
+PROFILE_LINES = 30
+
+logger = logging.getLogger('hdb.instrument')
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# process-wide totals, shared by every session and request thread
+_lock = threading.Lock()
+_span_totals = {}
+_counters = {}
+
+# per thread: the spans of the rerun in progress, each Streamlit session runs its script in its own thread
+_local = threading.local()
+
+
+class _Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.depth = getattr(_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        _local.depth = self.depth
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((self.start, self.depth, self.name, seconds))
+        with _lock:
+            total = _span_totals.setdefault(self.name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+        return False
+
+
+def span(name):
+    return _Span(name) if ENABLED else _NULL_SPAN
+
+
+def count(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def span_totals():
+    with _lock:
+        return {name: tuple(total) for name, total in _span_totals.items()}
+
+
+def _labels(pairs):
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}' if escaped else ''
+
+
+def prometheus_text():
+    # every span as a summary of seconds and every counter as a *_total, in the Prometheus text exposition format
+    lines = [f'# TYPE {METRIC_PREFIX}_span_seconds summary']
+    for name, (calls, seconds) in sorted(span_totals().items()):
+        lines.append(f'{METRIC_PREFIX}_span_seconds_sum{_labels([("span", name)])} {seconds:.6f}')
+        lines.append(f'{METRIC_PREFIX}_span_seconds_count{_labels([("span", name)])} {calls}')
+    by_name = {}
+    for (name, labels), value in counters().items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name, values in sorted(by_name.items()):
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name}_total counter')
+        lines.extend(f'{METRIC_PREFIX}_{name}_total{_labels(labels)} {value}' for labels, value in sorted(values))
+    return '\n'.join(lines) + '\n'
+
+
+def _start_profiler():
+    if PROFILER == 'pyinstrument':
+        # optional dependency, only imported when asked for
+        from pyinstrument import Profiler
+        profiler = Profiler()
+    elif PROFILER:
+        import cProfile
+        profiler = cProfile.Profile()
+    else:
+        return None
+    profiler.start() if PROFILER == 'pyinstrument' else profiler.enable()
+    return profiler
+
+
+def _profile_report(profiler):
+    if PROFILER == 'pyinstrument':
+        profiler.stop()
+        return profiler.output_text()
+    import pstats
+    profiler.disable()
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return report.getvalue()
+
+
+def start_rerun(page):
+    if not ENABLED:
+        return
+    # a rerun ended by st.stop() or an exception never reached finish_rerun(), only one profiler can be active
+    if getattr(_local, 'profiler', None) is not None:
+        _profile_report(_local.profiler)
+    _local.page, _local.spans, _local.depth = page, [], 0
+    _local.started = time.perf_counter()
+    _local.profiler = _start_profiler()
+
+
+def write_metrics(path):
+    with open(path + '.tmp', 'w') as f:
+        f.write(prometheus_text())
+    os.replace(path + '.tmp', path)
+
+
+def finish_rerun():
+    if not ENABLED or getattr(_local, 'spans', None) is None:
+        return
+    import streamlit as st
+
+    seconds = time.perf_counter() - _local.started
+    spans, page = _local.spans, _local.page
+    report = _profile_report(_local.profiler) if _local.profiler is not None else None
+    _local.spans, _local.profiler = None, None
+    with _lock:
+        total = _span_totals.setdefault(f'rerun {page}', [0, 0.0])
+        total[0] += 1
+        total[1] += seconds
+    logger.info('%s rerun in %.1f ms: %s', page, seconds * 1000, ', '.join(f'{name} {s * 1000:.1f} ms' for _, depth, name, s in spans if depth == 0))
+    if METRICS_FILE:
+        write_metrics(METRICS_FILE)
+    if st.query_params.get('debug') != '1':
+        return
+    with st.sidebar.expander('Debug: timings', expanded=True):
+        # spans are recorded as they close, sorted by start they read top-down with nested spans under their parent
+        st.text(f'rerun {seconds * 1000:.1f} ms\n' + '\n'.join(f"{'  ' * depth}{name:<{32 - 2 * depth}} {s * 1000:9.1f} ms"
+                                                               for _, depth, name, s in sorted(spans)))
+        st.text('\n'.join(f"{name}{_labels(labels)} {value}" for (name, labels), value in sorted(counters().items())))
+        if report:
+            st.text(report)
@@ -0,0 +1,150 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_scripts.datastore import CATEGORICAL_COLUMNS, MONTH_COLUMNS, SOURCES, STORE_DIR, ordinal_year, refresh, store_path
+from custom_scripts.geocode import load_geocoder
+from custom_scripts.prediction import RENTAL_REGIONS_MAPPER
+from custom_scripts.spatial import OPEN_MRT_COLUMN, amenity_features, open_mrt_index
+
+# Feature table used to train the resale and rental models, kept up to date incrementally. Run from the dashboard
+# directory after dropping a new data.gov.sg release into data/:
+#   python -m custom_scripts.pipeline            # only the months after the watermark
+#   python -m custom_scripts.pipeline --full     # rebuild everything
+#
+# Each run takes the transactions of the months after the watermark (plus the last REPROCESS_MONTHS, which
+# data.gov.sg still revises and whose CPI figure may not have been published on the previous run) from the
+# transaction store, adds coordinates, nearest amenity distances (custom_scripts.spatial), region and CPI the same
+# way the notebooks do, and rewrites only the year partitions those months fall in. The watermark is written last.
+# Next to the notebooks' static MRT distance, open_mrt_dist_km measures to the network as it was in the sale month.
+
+REPROCESS_MONTHS = 3
+
+CPI_SOURCE_PATH = 'auxillary/cpi.csv'
+
+
+def features_path(name):
+    # a directory of Parquet files partitioned by year=YYYY, like the transaction store
+    return os.path.join(STORE_DIR, f'{name}.features')
+
+
+def watermark_path(name):
+    return features_path(name) + '.watermark.json'
+
+
+def read_watermark(name):
+    if not os.path.exists(watermark_path(name)) or not os.path.exists(features_path(name)):
+        return None
+    with open(watermark_path(name)) as f:
+        return json.load(f)
+
+
+def load_cpi():
+    # month ordinal -> CPI, from the '2024 Feb ' formatted source
+    cpi = pd.read_csv(CPI_SOURCE_PATH, encoding='utf-8-sig')
+    months = pd.to_datetime(cpi['month'].str.strip(), format='%Y %b')
+    return pd.Series(cpi['cpi'].to_numpy(), index=(months.dt.year - 1970) * 12 + months.dt.month - 1).sort_index()
+
+
+def amenity_distances(coordinates):
+    # the notebooks' distances (the unit the models were trained on), plus km distances and amenity counts, once per
+    # distinct location rather than per transaction
+    unique, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+    return amenity_features(unique).iloc[inverse.ravel()].reset_index(drop=True)
+
+
+def open_mrt_distances(rows, coordinates, months):
+    # km to the nearest station open in each transaction's month, once per distinct (location, network epoch)
+    network = open_mrt_index()
+    keys = rows.astype(np.int64) * (len(network.epochs) + 1) + network.epoch_of(months) + 1
+    unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return network.nearest(coordinates[first], months[first])[inverse.ravel()]
+
+
+def build_features(name, df, geocoder, cpi):
+    month_col = MONTH_COLUMNS[name]
+    rows = geocoder.lookup(df['block'], df['street_name'])
+    # plain strings, so partitions written on different runs share one schema
+    df = df.astype({col: str for col in CATEGORICAL_COLUMNS if col in df.columns})
+    # transactions at an address without coordinates are dropped, as in the notebooks (python -m
+    # custom_scripts.geocode lists them)
+    df = df[rows >= 0].reset_index(drop=True)
+    coordinates = geocoder.coordinates[rows[rows >= 0]]
+    df['lat'], df['lng'] = coordinates[:, 0], coordinates[:, 1]
+    df = pd.concat([df, amenity_distances(coordinates)], axis=1)
+    df[OPEN_MRT_COLUMN] = open_mrt_distances(rows[rows >= 0], coordinates, df[month_col].to_numpy())
+    df['region'] = df['town'].map(RENTAL_REGIONS_MAPPER)
+    if name == 'resale':
+        df['cpi'] = df[month_col].map(cpi).astype('float64')
+        df['real_resale_price'] = df['resale_price'] / df['cpi'] * 100
+    return df
+
+
+def update(name, full=False):
+    month_col = MONTH_COLUMNS[name]
+    path = features_path(name)
+    watermark = None if full else read_watermark(name)
+    if watermark is None:
+        shutil.rmtree(path, ignore_errors=True)
+
+    refresh(name)
+    start = None if watermark is None else watermark['month'] - REPROCESS_MONTHS + 1
+    filters = None if start is None else [('year', '>=', ordinal_year(start))]
+    df = pd.read_parquet(store_path(name), filters=filters).drop(columns='year')
+    if start is not None:
+        df = df[df[month_col] >= start]
+    if df.empty:
+        return {'name': name, 'months': 0, 'rows': 0, 'watermark': None if watermark is None else watermark['month']}
+
+    features = build_features(name, df.reset_index(drop=True), load_geocoder(), load_cpi())
+    years = ordinal_year(features[month_col])
+    last = int(df[month_col].max())
+    # every partition from the first reprocessed month on is rewritten: the rows before it are kept, the rest replaced
+    for year in range(ordinal_year(int(df[month_col].min()) if start is None else start), ordinal_year(last) + 1):
+        partition = os.path.join(path, f'year={year}')
+        kept = [] if start is None else [pd.read_parquet(file) for file in glob.glob(os.path.join(partition, '*.parquet'))]
+        frame = pd.concat([*[old[old[month_col] < start] for old in kept], features[years == year]], ignore_index=True)
+        if frame.empty:
+            continue
+        os.makedirs(partition, exist_ok=True)
+        frame.to_parquet(os.path.join(partition, 'part.parquet.tmp'), index=False)
+        os.replace(os.path.join(partition, 'part.parquet.tmp'), os.path.join(partition, 'part.parquet'))
+
+    with open(watermark_path(name) + '.tmp', 'w') as f:
+        json.dump({'month': last, 'updated': time.time()}, f)
+    os.replace(watermark_path(name) + '.tmp', watermark_path(name))
+    return {'name': name, 'months': int(df[month_col].nunique()), 'rows': len(features), 'dropped': len(df) - len(features),
+            'watermark': last}
+
+
+def load_features(name):
+    df = pd.read_parquet(features_path(name)).drop(columns='year')
+    return df.astype({col: 'category' for col in [*CATEGORICAL_COLUMNS, 'region'] if col in df.columns})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bring the model feature tables up to date with the transaction data')
+    parser.add_argument('names', nargs='*', help=f"datasets to update, {' and '.join(SOURCES)} by default")
+    parser.add_argument('--full', action='store_true', help='rebuild the feature tables from scratch')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in SOURCES]
+    if unknown:
+        parser.error(f"unknown dataset(s): {', '.join(unknown)}")
+
+    for name in args.names or SOURCES:
+        start = time.perf_counter()
+        summary = update(name, args.full)
+        month = summary['watermark']
+        watermark = '-' if month is None else f'{ordinal_year(month)}-{month % 12 + 1:02d}'
+        print(f"{name}: {summary['rows']} rows over {summary['months']} month(s) processed, "
+              f"{summary.get('dropped', 0)} without coordinates dropped, watermark {watermark}, {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
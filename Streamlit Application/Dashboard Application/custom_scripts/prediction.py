@@ -0,0 +1,272 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from custom_scripts.artifacts import load_model
+from custom_scripts.instrument import count, span
+from custom_scripts.transforms import COLUMN_PARSERS, FLAT_MODELS, FLAT_TYPES
+
+RESALE_REGIONS_MAPPER = {'ANG MO KIO':'North East', 'BEDOK':'East', 'BISHAN':'Central', 'BUKIT BATOK':'West', 'BUKIT MERAH':'Central',
+       'BUKIT PANJANG':'West', 'BUKIT TIMAH':'Central', 'CHOA CHU KANG':'West',
+       'CLEMENTI':'West', 'GEYLANG':'Central', 'HOUGANG':'North East', 'JURONG EAST':'West', 'JURONG WEST':'West',
+       'KALLANG/WHAMPOA':'Central', 'MARINE PARADE':'Central', 'PASIR RIS':'East', 'PUNGGOL':'North East',
+       'QUEENSTOWN':'Central', 'SEMBAWANG':'North', 'SENGKANG':'North East', 'SERANGOON':'North East', 'TAMPINES':'East',
+       'TOA PAYOH':'Central', 'WOODLANDS':'North', 'YISHUN':'North'}
+
+# the rental models were also trained on CENTRAL, kept in alphabetical order like the rest
+RENTAL_REGIONS_MAPPER = dict(sorted({**RESALE_REGIONS_MAPPER, 'CENTRAL': 'North'}.items()))
+
+REGIONS = ['Central', 'East', 'North', 'North East', 'West']
+
+MONTHS = {'January': 1, 'Febraury': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12}
+
+RESALE_TOWNS = list(RESALE_REGIONS_MAPPER.keys())
+
+RENTAL_TOWNS = list(RENTAL_REGIONS_MAPPER.keys())
+
+AMENITY_COLUMNS = ['mrt_dist', 'school_dist', 'mall_dist', 'upcoming_mrt_dist']
+
+# feature order the models were trained on
+RESALE_COLUMNS = ['flat_type', 'storey_range', 'floor_area_sqm', 'lease_commence_date', 'remaining_lease', *AMENITY_COLUMNS, 'cpi'] + \
+                 ['model_' + model for model in FLAT_MODELS] + \
+                 ['region_' + region for region in REGIONS] + \
+                 ['town_' + town for town in RESALE_TOWNS] + \
+                 ['month_sin', 'month_cos']
+
+RENTAL_COLUMNS = ['flat_type'] + \
+                 ['region_' + region for region in REGIONS] + \
+                 ['town_' + town for town in RENTAL_TOWNS] + \
+                 ['rent_approval_month', 'rent_approval_year', *AMENITY_COLUMNS]
+
+# one listing per row, month as a number 1-12. storey_range, flat_type and flat_model may also be given as in the
+# data.gov.sg files ('10 TO 12', '3 ROOM', 'IMPROVED'), see custom_scripts.transforms
+RESALE_LISTING_COLUMNS = ['town', 'street_name', 'flat_type', 'flat_model', 'storey_range', 'floor_area_sqm', 'lease_commence_date', 'year', 'month']
+
+RENTAL_LISTING_COLUMNS = ['town', 'street_name', 'flat_type', 'year', 'month']
+
+NUMERIC_LISTING_COLUMNS = ['storey_range', 'floor_area_sqm', 'lease_commence_date', 'year', 'month']
+
+RESALE_MODELS = {
+    'random_forest': 'models/resale/random_forest_model.pkl',
+    'voting_regressor': 'models/resale/voting_regressor.pkl',
+    'stacking_regressor': 'models/resale/stacking_regressor.pkl',
+}
+
+RENTAL_MODELS = {
+    'random_forest': 'models/rental/rf_regressor.pkl',
+    'grid_search_knn': 'models/rental/grid_search_knn.pkl',
+    'grid_search_xgb': 'models/rental/grid_search_xgb.pkl',
+}
+
+STREETS_AMENITIES_PATH = 'auxillary/streets_towns_amenities.csv'
+
+CPI_PATH = 'auxillary/cpi_mod.csv'
+
+# memory budget of each PredictionCache, and the bookkeeping counted per entry on top of its key and values
+PREDICTION_CACHE_BYTES = 16 * 1024 * 1024
+PREDICTION_CACHE_ENTRY_OVERHEAD = 200
+
+
+def check_feature_names(model, columns):
+    # the encoders write by column position, refuse a model fitted on a different layout
+    names = getattr(model, 'feature_names_in_', None)
+    if names is not None and list(names) != list(columns):
+        raise ValueError(f'{type(model).__name__} was fitted on different features than {columns[:3]}...')
+
+
+def load_models(paths, columns):
+    models = {name: load_model(path) for name, path in paths.items()}
+    for model in models.values():
+        check_feature_names(model, columns)
+    return models
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ListingEncoder:
+    # Turns listings into the feature matrix a model expects. Every lookup the encoding needs, the
+    # (town, street) -> amenity row index, category codes and the column position of each one-hot
+    # feature, is computed once here so encoding a listing is a few array reads and writes.
+    columns = []
+    listing_columns = []
+    numeric_columns = []
+
+    def __init__(self, regions_mapper, streets_amenities, categories=None):
+        self.col = {name: i for i, name in enumerate(self.columns)}
+        self.categories = {'town': list(regions_mapper), **(categories or {})}
+        self.category_codes = {field: {value: i for i, value in enumerate(values)} for field, values in self.categories.items()}
+        self.town_columns = np.array([self.col['town_' + town] for town in regions_mapper])
+        self.region_columns = np.array([self.col['region_' + region] for region in regions_mapper.values()])
+
+        streets = streets_amenities.drop_duplicates(['town', 'street_name'])
+        self.streets = pd.MultiIndex.from_frame(streets[['town', 'street_name']])
+        self.street_rows = {key: i for i, key in enumerate(self.streets)}
+        self.street_names = streets.groupby('town')['street_name'].apply(list).to_dict()
+        self.amenities = streets[AMENITY_COLUMNS].to_numpy(dtype=float)
+        self.amenity_columns = slice(self.col[AMENITY_COLUMNS[0]], self.col[AMENITY_COLUMNS[0]] + len(AMENITY_COLUMNS))
+
+    def streets_in(self, town):
+        return self.street_names.get(town, [])
+
+    def encode(self, listings):
+        # vectorized over a frame of listings, returns the features and a mask of rows that could be encoded
+        parsed = {c: parse(listings[c]) for c, (parse, _) in COLUMN_PARSERS.items() if c in listings.columns}
+        fields = {c: parsed[c].astype(float) if c in parsed else pd.to_numeric(listings[c], errors='coerce').to_numpy(dtype=float)
+                  for c in self.numeric_columns}
+        fields.update({c: pd.Categorical(parsed.get(c, listings[c]), categories=values).codes for c, values in self.categories.items()})
+        fields['street'] = self.streets.get_indexer(pd.MultiIndex.from_arrays([listings['town'], listings['street_name']]))
+        fields['flat_type'] = parsed['flat_type']
+        return self._fill(fields, len(listings))
+
+    def encode_row(self, listing):
+        # a single listing given as a mapping, plain dict lookups without building a frame; None if it cannot be encoded
+        parsed = {c: parse(listing.get(c)) for c, (_, parse) in COLUMN_PARSERS.items()}
+        fields = {c: np.array([parsed[c] if c in parsed else _to_float(listing.get(c))]) for c in self.numeric_columns}
+        fields.update({c: np.array([codes.get(parsed.get(c, listing.get(c)), -1)]) for c, codes in self.category_codes.items()})
+        fields['street'] = np.array([self.street_rows.get((listing.get('town'), listing.get('street_name')), -1)])
+        fields['flat_type'] = np.array([parsed['flat_type']])
+        features, valid = self._fill(fields, 1)
+        return features[0] if valid[0] else None
+
+    def _fill(self, fields, n):
+        features = np.zeros((n, len(self.columns)))
+        valid = np.all([fields[c] >= 0 for c in [*self.categories, 'street']], axis=0)
+        rows = np.flatnonzero(valid)
+        town, street = fields['town'][rows], fields['street'][rows]
+        features[rows, self.town_columns[town]] = 1
+        features[rows, self.region_columns[town]] = 1
+        features[rows, self.amenity_columns] = self.amenities[street]
+        features[:, self.col['flat_type']] = fields['flat_type']
+        self._fill_listing(features, fields, rows)
+        valid &= ~np.isnan(features).any(axis=1)
+        return features, valid
+
+
+class ResaleEncoder(ListingEncoder):
+    columns = RESALE_COLUMNS
+    listing_columns = RESALE_LISTING_COLUMNS
+    numeric_columns = NUMERIC_LISTING_COLUMNS
+
+    def __init__(self, streets_amenities, cpi_df):
+        super().__init__(RESALE_REGIONS_MAPPER, streets_amenities, {'flat_model': FLAT_MODELS})
+        # (year, month) -> CPI as a dense array, NaN for months without a figure
+        self.first_cpi_year = int(cpi_df['year'].min())
+        self.cpi = np.full((int(cpi_df['year'].max()) - self.first_cpi_year + 1, 12), np.nan)
+        self.cpi[cpi_df['year'] - self.first_cpi_year, cpi_df['month'] - 1] = cpi_df['cpi']
+
+    def _cpi(self, year, month):
+        year_index, month_index = year - self.first_cpi_year, month - 1
+        known = (year_index >= 0) & (year_index < len(self.cpi)) & (month_index >= 0) & (month_index < 12)
+        cpi = np.full(len(year), np.nan)
+        cpi[known] = self.cpi[year_index[known].astype(int), month_index[known].astype(int)]
+        return cpi
+
+    def _fill_listing(self, features, fields, rows):
+        col = self.col
+        year, month = fields['year'], fields['month']
+        features[:, col['storey_range']] = fields['storey_range']
+        features[:, col['floor_area_sqm']] = fields['floor_area_sqm']
+        features[:, col['lease_commence_date']] = fields['lease_commence_date']
+        features[:, col['remaining_lease']] = 99 + fields['lease_commence_date'] - year
+        features[:, col['cpi']] = self._cpi(year, month)
+        features[rows, col['model_' + FLAT_MODELS[0]] + fields['flat_model'][rows]] = 1
+        features[:, col['month_sin']] = np.sin((month - 1) * (2. * np.pi / 12))
+        features[:, col['month_cos']] = np.cos((month - 1) * (2. * np.pi / 12))
+
+
+class RentalEncoder(ListingEncoder):
+    columns = RENTAL_COLUMNS
+    listing_columns = RENTAL_LISTING_COLUMNS
+    numeric_columns = ['year', 'month']
+
+    def __init__(self, streets_amenities):
+        super().__init__(RENTAL_REGIONS_MAPPER, streets_amenities)
+
+    def _fill_listing(self, features, fields, rows):
+        features[:, self.col['rent_approval_month']] = fields['month']
+        features[:, self.col['rent_approval_year']] = fields['year']
+
+
+def create_resale_encoder():
+    return ResaleEncoder(pd.read_csv(STREETS_AMENITIES_PATH), pd.read_csv(CPI_PATH))
+
+
+def create_rental_encoder():
+    return RentalEncoder(pd.read_csv(STREETS_AMENITIES_PATH))
+
+
+def predict_batch(models, features, columns):
+    # each model runs once over the whole matrix, the frame only carries the feature names the models were fit with
+    frame = pd.DataFrame(features, columns=columns, copy=False)
+    count('rows_predicted', len(frame))
+    with span('predict'):
+        return {name: model.predict(frame) for name, model in models.items()}
+
+
+def sweep_listings(listing, *axes):
+    # the listing once per combination of the axes' values, as a frame of listings to encode in one go. Each axis is
+    # a frame of alternatives for one or more fields (storeys, or (year, month) pairs), crossed with the other axes
+    grid = axes[0]
+    for axis in axes[1:]:
+        grid = grid.merge(axis, how='cross')
+    return grid.assign(**{field: value for field, value in listing.items() if field not in grid.columns})
+
+
+class PredictionCache:
+    # Least recently used {model: prediction} per encoded feature vector, shared by every session of a page. The
+    # vector's bytes are the key, so listings that encode identically (same town, street, flat and month) share an
+    # entry, and entries are evicted oldest first once their keys and values outgrow max_bytes.
+    def __init__(self, models, columns, max_bytes=PREDICTION_CACHE_BYTES):
+        self.models = models
+        self.columns = columns
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def predict(self, features):
+        # same result as predict_batch(models, features, columns), running the models only on the uncached rows
+        features = np.ascontiguousarray(features, dtype=np.float64)
+        keys = [row.tobytes() for row in features]
+        results = [None] * len(keys)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    results[i] = self.entries[key]
+            missing = [i for i, result in enumerate(results) if result is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        count('cache_requests', len(keys), cache='prediction')
+        count('cache_misses', len(missing), cache='prediction')
+        if missing:
+            predictions = predict_batch(self.models, features[missing], self.columns)
+            with self.lock:
+                for j, i in enumerate(missing):
+                    results[i] = {name: values[j] for name, values in predictions.items()}
+                    self._store(keys[i], results[i])
+        return {name: np.array([result[name] for result in results]) for name in self.models}
+
+    def _store(self, key, values):
+        if key in self.entries:
+            return
+        self.entries[key] = values
+        self.size += len(key) + 8 * len(values) + PREDICTION_CACHE_ENTRY_OVERHEAD
+        while self.size > self.max_bytes and self.entries:
+            old_key, old_values = self.entries.popitem(last=False)
+            self.size -= len(old_key) + 8 * len(old_values) + PREDICTION_CACHE_ENTRY_OVERHEAD
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'bytes': self.size}
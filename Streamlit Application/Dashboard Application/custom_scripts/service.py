@@ -0,0 +1,128 @@
+import argparse
+import json
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from custom_scripts.instrument import prometheus_text, span
+from custom_scripts.prediction import RESALE_MODELS, RENTAL_MODELS, PredictionCache, load_models, create_resale_encoder, \
+    create_rental_encoder
+
+# Headless prediction server, run from the dashboard directory:
+#   python -m custom_scripts.service --port 8000
+#
+#   POST /predict/resale   {"town": ..., "street_name": ..., "flat_type": ..., "flat_model": ..., "storey_range": ...,
+#                           "floor_area_sqm": ..., "lease_commence_date": ..., "year": ..., "month": 1-12}
+#   POST /predict/rental   {"town": ..., "street_name": ..., "flat_type": ..., "year": ..., "month": 1-12}
+#   GET  /health           models loaded and prediction cache hit/miss counters
+#   GET  /metrics          span timings and counters in Prometheus text format (with HDB_INSTRUMENT=1, see
+#                          custom_scripts.instrument)
+#
+# A JSON object is priced as one listing and answered with {model: price}; a JSON list is priced as one batch and
+# answered with a list in the same order, null for listings that could not be encoded.
+
+
+class Predictor:
+    def __init__(self, models, encoder):
+        self.models = models
+        self.encoder = encoder
+        self.cache = PredictionCache(models, encoder.columns)
+
+    def predict(self, listings):
+        if not listings:
+            return []
+        missing = [col for col in self.encoder.listing_columns if any(col not in listing for listing in listings)]
+        if missing:
+            raise ValueError(f"missing field(s): {', '.join(missing)}")
+        with span('encode'):
+            if len(listings) == 1:
+                row = self.encoder.encode_row(listings[0])
+                features, valid = (np.zeros((1, len(self.encoder.columns))), np.array([False])) if row is None else (row[None], np.array([True]))
+            else:
+                features, valid = self.encoder.encode(pd.DataFrame(listings))
+        predictions = self.cache.predict(features[valid]) if valid.any() else {}
+        results = [None] * len(listings)
+        for i, row in enumerate(np.flatnonzero(valid)):
+            results[row] = {name: float(values[i]) for name, values in predictions.items()}
+        return results
+
+
+def create_predictors():
+    # models and lookup tables are loaded once per process and shared by every request thread
+    resale_encoder, rental_encoder = create_resale_encoder(), create_rental_encoder()
+    return {
+        'resale': Predictor(load_models(RESALE_MODELS, resale_encoder.columns), resale_encoder),
+        'rental': Predictor(load_models(RENTAL_MODELS, rental_encoder.columns), rental_encoder),
+    }
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # keep-alive connections so clients do not pay a TCP handshake per prediction, and no Nagle delay
+    # between the header and body writes of a response
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    predictors = {}
+
+    def _send(self, status, body, content_type='application/json'):
+        payload = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok', 'models': {kind: list(p.models) for kind, p in self.predictors.items()},
+                             'cache': {kind: p.cache.stats() for kind, p in self.predictors.items()}})
+        elif self.path == '/metrics':
+            self._send(200, prometheus_text(), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        kind = self.path.removeprefix('/predict/')
+        if kind not in self.predictors:
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            single = isinstance(body, dict)
+            listings = [body] if single else body
+            if not all(isinstance(listing, dict) for listing in listings):
+                raise ValueError('expected a listing object or a list of listing objects')
+            start = time.perf_counter()
+            results = self.predictors[kind].predict(listings)
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # a well-formed request the encoder or a model failed on still gets an answer, and the server a traceback
+            self.log_error('%s failed: %r', self.path, e)
+            traceback.print_exc()
+            self._send(500, {'error': f'prediction failed: {type(e).__name__}'})
+            return
+        self.log_message('%s %d listing(s) in %.2f ms', self.path, len(listings), (time.perf_counter() - start) * 1000)
+        if single and results[0] is None:
+            self._send(422, {'error': 'listing could not be encoded, check town, street, flat type and month'})
+        else:
+            self._send(200, results[0] if single else results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the resale and rental models over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    PredictionHandler.predictors = create_predictors()
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    print(f'Serving predictions on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+# Nearest-amenity and amenity-count features. Each amenity layer gets one haversine BallTree over its points in
+# radians, built once per process, and every query is batched over all the locations passed in.
+#
+# The models were trained on the notebooks' distances, haversine applied to raw degrees as if they were radians.
+# These 'legacy' units are not a length (longitude ends up scaled by cos(1.3 rad) instead of cos(1.3 deg)), but the
+# columns keep their names (mrt_dist, ...) and values so the models stay valid; *_dist_km columns carry the real
+# great-circle distance. Regenerate the predict pages' street table (auxillary/streets_towns_amenities.csv) from the
+# dashboard directory with
+#   python -m custom_scripts.spatial
+
+EARTH_RADIUS_KM = 6371.0088
+
+AMENITY_LAYERS = {
+    'mrt': 'auxillary/sg-mrt-existing-stations.csv',
+    'school': 'auxillary/sg-primary-schools.csv',
+    'mall': 'auxillary/sg-shopping-malls.csv',
+    'upcoming_mrt': 'auxillary/sg-mrt-planned-stations.csv',
+}
+
+# amenities counted around each location, in km
+AMENITY_RADII = {
+    'mrt': 0.5,
+    'school': 1.0,
+}
+
+# distance to the nearest MRT station already open in the transaction month
+OPEN_MRT_COLUMN = 'open_mrt_dist_km'
+
+
+class AmenityIndex:
+    def __init__(self, latlng, names=None):
+        # latlng in degrees, one row per amenity
+        self.latlng = np.asarray(latlng, dtype=float)
+        self.names = names
+        self.tree = BallTree(np.radians(self.latlng), metric='haversine')
+        self.legacy_tree = BallTree(self.latlng, metric='haversine')
+
+    def nearest(self, latlng, k=1, units='km'):
+        # (distances, indices) of the k nearest amenities to each location, each of shape (n, k)
+        latlng = np.asarray(latlng, dtype=float)
+        if units == 'legacy':
+            return self.legacy_tree.query(latlng, k=k)
+        distances, indices = self.tree.query(np.radians(latlng), k=k)
+        return distances * EARTH_RADIUS_KM, indices
+
+    def within(self, latlng, radius_km, count_only=True):
+        # number of amenities (or their indices) within radius_km of each location
+        return self.tree.query_radius(np.radians(np.asarray(latlng, dtype=float)), r=radius_km / EARTH_RADIUS_KM, count_only=count_only)
+
+
+class TemporalAmenityIndex:
+    # Amenities that appear over time. The network only changes in the months something opens, so queries are grouped
+    # by epoch (the latest opening at or before their month) and each epoch gets one AmenityIndex, built on first use.
+    def __init__(self, latlng, opened):
+        # opened: month ordinal from which each amenity is available
+        order = np.argsort(opened, kind='stable')
+        self.latlng = np.asarray(latlng, dtype=float)[order]
+        self.opened = np.asarray(opened)[order]
+        self.epochs = np.unique(self.opened)
+        self._epoch_indexes = {}
+
+    def epoch_of(self, months):
+        # index into epochs of the network in force at each month, -1 before anything opened
+        return np.searchsorted(self.epochs, months, side='right') - 1
+
+    def epoch_index(self, epoch):
+        if epoch not in self._epoch_indexes:
+            self._epoch_indexes[epoch] = AmenityIndex(self.latlng[:np.searchsorted(self.opened, self.epochs[epoch], side='right')])
+        return self._epoch_indexes[epoch]
+
+    def nearest(self, latlng, months, units='km'):
+        # distance to the nearest amenity open at each (location, month), NaN before the first opening
+        latlng = np.asarray(latlng, dtype=float)
+        epochs = self.epoch_of(np.asarray(months))
+        order = np.argsort(epochs, kind='stable')
+        bounds = np.searchsorted(epochs[order], np.arange(-1, len(self.epochs) + 1))
+        distances = np.full(len(latlng), np.nan)
+        for epoch in range(len(self.epochs)):
+            rows = order[bounds[epoch + 1]:bounds[epoch + 2]]
+            if rows.size:
+                distances[rows] = self.epoch_index(epoch).nearest(latlng[rows], units=units)[0][:, 0]
+        return distances
+
+
+_indexes = {}
+
+
+def amenity_index(layer):
+    if layer not in _indexes:
+        points = pd.read_csv(AMENITY_LAYERS[layer])
+        _indexes[layer] = AmenityIndex(points[['latitude', 'longitude']], points['name'].to_numpy())
+    return _indexes[layer]
+
+
+def open_mrt_index():
+    # existing stations from their opening month, planned ones from the December of their opening year (only the
+    # year is known)
+    if 'open_mrt' not in _indexes:
+        existing = pd.read_csv(AMENITY_LAYERS['mrt'])
+        planned = pd.read_csv(AMENITY_LAYERS['upcoming_mrt'])
+        stations = pd.concat([existing, planned], ignore_index=True)
+        opened = np.concatenate([(existing['year'] - 1970) * 12 + existing['month'] - 1, (planned['opening_year'] - 1970) * 12 + 11])
+        _indexes['open_mrt'] = TemporalAmenityIndex(stations[['latitude', 'longitude']], opened)
+    return _indexes['open_mrt']
+
+
+def distance_column(layer, units='legacy'):
+    return f'{layer}_dist' if units == 'legacy' else f'{layer}_dist_{units}'
+
+
+def count_column(layer, radius_km):
+    return f'{layer}_within_{round(radius_km * 1000)}m'
+
+
+def amenity_features(latlng, units=('legacy', 'km'), radii=AMENITY_RADII):
+    # one row per location: nearest distance to every layer in each of units, plus the counts within radii
+    latlng = np.asarray(latlng, dtype=float)
+    columns = {}
+    for unit in units:
+        for layer in AMENITY_LAYERS:
+            columns[distance_column(layer, unit)] = amenity_index(layer).nearest(latlng, units=unit)[0][:, 0]
+    for layer, radius_km in radii.items():
+        columns[count_column(layer, radius_km)] = amenity_index(layer).within(latlng, radius_km)
+    return pd.DataFrame(columns)
+
+
+def build_streets_amenities(geocoder, transactions):
+    # the street table the predict pages' encoders read, in its own schema: each (street_name, town) at the mean
+    # coordinates of its transactions' blocks, with the legacy distances the models take measured from there.
+    # transactions: frame of block, street_name, town, one row per transaction
+    ids = geocoder.lookup(transactions['block'], transactions['street_name'])
+    located = transactions[ids >= 0].assign(lat=geocoder.coordinates[ids[ids >= 0], 0], lng=geocoder.coordinates[ids[ids >= 0], 1])
+    streets = located.groupby(['street_name', 'town'], as_index=False)[['lat', 'lng']].mean()
+    return pd.concat([streets, amenity_features(streets[['lat', 'lng']], units=('legacy',), radii={})], axis=1)
+
+
+if __name__ == '__main__':
+    from custom_scripts.datastore import SOURCES, refresh, store_path
+    from custom_scripts.geocode import load_geocoder
+    from custom_scripts.prediction import STREETS_AMENITIES_PATH
+
+    start = time.perf_counter()
+    transactions = []
+    for name in SOURCES:
+        refresh(name)
+        transactions.append(pd.read_parquet(store_path(name), columns=['block', 'street_name', 'town']).astype(str))
+    streets = build_streets_amenities(load_geocoder(), pd.concat(transactions, ignore_index=True))
+    streets.to_csv(STREETS_AMENITIES_PATH + '.tmp', index=False)
+    os.replace(STREETS_AMENITIES_PATH + '.tmp', STREETS_AMENITIES_PATH)
+    print(f'{len(streets)} streets -> {STREETS_AMENITIES_PATH} in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.ensemble import AdaBoostRegressor, RandomForestRegressor, StackingRegressor, VotingRegressor
+from sklearn.linear_model import Ridge
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import KFold, train_test_split
+from sklearn.neighbors import KNeighborsRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+from custom_scripts.artifacts import export
+from custom_scripts.datastore import SOURCES, STORE_DIR
+from custom_scripts.feature_store import load_matrix
+from custom_scripts.prediction import RENTAL_MODELS, RESALE_MODELS
+
+# Retrains the models behind the predict pages from the encoded feature matrix (custom_scripts.feature_store). Run
+# from the dashboard directory:
+#   python -m custom_scripts.train                    # every model of both datasets
+#   python -m custom_scripts.train resale --jobs 8
+#
+# Each model has a parameter grid taken from the notebooks. Candidates are compared by successive halving: every
+# round scores the remaining candidates by K-fold MSE on a larger sample of the training split and keeps the best
+# 1/HALVING_FACTOR, until one candidate is left or the sample is the whole split. Every (candidate, sample, fold) fit
+# is a task for a process pool whose workers memory-map the matrix and index their rows out of it, and every score
+# is written to data/store/training/ as soon as it is known, so an interrupted run picks up where it stopped. The
+# winner is refit on the training split, scored on the notebooks' held-out split and written to its models/ path
+# together with its compact artifact.
+
+TRAINING_DIR = os.path.join(STORE_DIR, 'training')
+
+TEST_SIZE = {'resale': 0.1, 'rental': 0.2}
+
+CV_FOLDS = 5
+HALVING_FACTOR = 3
+MIN_SAMPLES = 5000
+
+_ADABOOST = AdaBoostRegressor(estimator=DecisionTreeRegressor(max_depth=None), random_state=0)
+
+# model name -> (estimator, parameter grid)
+SEARCHES = {
+    'resale': {
+        'random_forest': (RandomForestRegressor(max_depth=50, random_state=0),
+                          {'min_samples_leaf': [1, 5, 20], 'n_estimators': [100]}),
+        'voting_regressor': (VotingRegressor([('rf', RandomForestRegressor(random_state=0)), ('adaboost', _ADABOOST)]),
+                             {'rf__min_samples_leaf': [1, 5], 'adaboost__n_estimators': [50, 100]}),
+        'stacking_regressor': (StackingRegressor([('adaboost', _ADABOOST), ('ridge', Ridge())],
+                                                 final_estimator=RandomForestRegressor(random_state=0), cv=5),
+                               {'ridge__alpha': [0.5, 1.0], 'final_estimator__min_samples_leaf': [1, 20]}),
+    },
+    'rental': {
+        'random_forest': (RandomForestRegressor(n_estimators=100, random_state=0),
+                          {'min_samples_leaf': [1, 5, 20]}),
+        # the notebook also searched the neighbour algorithm, which does not change the predictions
+        'grid_search_knn': (KNeighborsRegressor(),
+                            {'n_neighbors': [3, 5, 7, 10], 'weights': ['uniform', 'distance']}),
+        'grid_search_xgb': ('xgboost.XGBRegressor',
+                            {'n_estimators': [100, 200, 300], 'learning_rate': [0.01, 0.1, 0.2], 'max_depth': [3, 4, 5]}),
+    },
+}
+
+MODEL_PATHS = {'resale': RESALE_MODELS, 'rental': RENTAL_MODELS}
+
+
+def base_estimator(name, model):
+    estimator = SEARCHES[name][model][0]
+    if isinstance(estimator, str):
+        # optional dependency, only imported when its model is trained
+        from xgboost import XGBRegressor
+        estimator = XGBRegressor(random_state=0, n_jobs=1)
+    return clone(estimator)
+
+
+def candidates(name, model):
+    grid = SEARCHES[name][model][1]
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def result_path(run_dir, name, model, params, n_samples, fold):
+    # keyed on the estimator's definition too, so editing SEARCHES does not reuse stale scores
+    definition = [repr(base_estimator(name, model)), params, n_samples, CV_FOLDS, fold]
+    key = hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(run_dir, 'results', f'{model}-{key}.json')
+
+
+def _sample(n_train, n_samples):
+    # nested samples: every round's sample contains the previous one
+    return np.random.default_rng(0).permutation(n_train)[:n_samples]
+
+
+_worker = {}
+
+
+def _has_linear_model(estimator):
+    parts = [estimator, *estimator.get_params().values()]
+    return any(type(part).__module__.startswith('sklearn.linear_model') for part in parts)
+
+
+def _frame(X, rows, columns, estimator):
+    # only the rows a fit needs are read out of the memory map, the frame just names them. Trees and XGBoost split on
+    # float32 anyway; linear models would solve in float32 and get float64 rows
+    dtype = np.float64 if _has_linear_model(estimator) else X.dtype
+    return pd.DataFrame(X[rows].astype(dtype, copy=False), columns=columns, copy=False)
+
+
+def _init_worker(name, run_dir):
+    _worker['name'] = name
+    _worker['X'], _worker['y'], manifest = load_matrix(name)
+    _worker['columns'] = manifest['columns']
+    _worker['train_rows'] = np.load(os.path.join(run_dir, 'train_rows.npy'))
+
+
+def _fit_fold(task):
+    model, params, n_samples, fold, path = task
+    X, y, columns = _worker['X'], _worker['y'], _worker['columns']
+    rows = _worker['train_rows'][np.sort(_sample(len(_worker['train_rows']), n_samples))]
+    train, test = list(KFold(CV_FOLDS, shuffle=True, random_state=0).split(rows))[fold]
+    estimator = base_estimator(_worker['name'], model).set_params(**params)
+    start = time.perf_counter()
+    estimator.fit(_frame(X, rows[train], columns, estimator), y[rows[train]])
+    mse = mean_squared_error(y[rows[test]], estimator.predict(_frame(X, rows[test], columns, estimator)))
+    result = {'model': model, 'params': params, 'n_samples': n_samples, 'fold': fold, 'mse': float(mse),
+              'seconds': time.perf_counter() - start}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+    return result
+
+
+def halving_rounds(n_train, n_candidates):
+    # sample size of each round, growing by HALVING_FACTOR up to the whole training split
+    rounds = max(1, int(np.ceil(np.log(max(n_candidates, 1)) / np.log(HALVING_FACTOR))))
+    sizes = [min(n_train, max(MIN_SAMPLES, n_train // HALVING_FACTOR ** (rounds - 1 - i))) for i in range(rounds)]
+    return sorted(set(sizes))
+
+
+def search(name, models, jobs, run_dir, log=print):
+    # successive halving of every model's candidates, all models' fits of a round sharing the pool
+    n_train = len(np.load(os.path.join(run_dir, 'train_rows.npy')))
+    remaining = {model: candidates(name, model) for model in models}
+    os.makedirs(os.path.join(run_dir, 'results'), exist_ok=True)
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(name, run_dir)) as pool:
+        for n_samples in halving_rounds(n_train, max(len(c) for c in remaining.values())):
+            active = {model: params_list for model, params_list in remaining.items() if len(params_list) > 1}
+            if not active:
+                break
+            tasks, scores = [], {}
+            for model, params_list in active.items():
+                for i, params in enumerate(params_list):
+                    for fold in range(CV_FOLDS):
+                        path = result_path(run_dir, name, model, params, n_samples, fold)
+                        if os.path.exists(path):
+                            with open(path) as f:
+                                scores.setdefault((model, i), []).append(json.load(f)['mse'])
+                        else:
+                            tasks.append(((model, i), (model, params, n_samples, fold, path)))
+            log(f'{name}: {n_samples} samples, {sum(map(len, active.values()))} candidates, '
+                f'{len(tasks)} fits to run, {sum(map(len, scores.values()))} cached')
+            for (key, _), result in zip(tasks, pool.map(_fit_fold, [task for _, task in tasks])):
+                scores.setdefault(key, []).append(result['mse'])
+            for model, params_list in active.items():
+                ranked = sorted(range(len(params_list)), key=lambda i: np.mean(scores[(model, i)]))
+                keep = max(1, int(np.ceil(len(params_list) / HALVING_FACTOR))) if n_samples < n_train else 1
+                remaining[model] = [params_list[i] for i in ranked[:keep]]
+                log(f'  {model}: best cv rmse {np.sqrt(np.mean(scores[(model, ranked[0])])):.1f} with {params_list[ranked[0]]}')
+    return {model: params_list[0] for model, params_list in remaining.items()}
+
+
+def train(name, models=None, jobs=None, fresh=False, log=print):
+    models = models or list(SEARCHES[name])
+    X, y, manifest = load_matrix(name)
+    columns = manifest['columns']
+    train_rows, test_rows = train_test_split(np.arange(len(y)), test_size=TEST_SIZE[name], shuffle=True, random_state=0)
+    run_dir = os.path.join(TRAINING_DIR, f"{name}-{manifest['fingerprint']}")
+    if fresh and os.path.exists(os.path.join(run_dir, 'results')):
+        for file in os.listdir(os.path.join(run_dir, 'results')):
+            os.remove(os.path.join(run_dir, 'results', file))
+    os.makedirs(run_dir, exist_ok=True)
+    np.save(os.path.join(run_dir, 'train_rows.npy'), train_rows)
+    log(f'{name}: {len(train_rows)} training and {len(test_rows)} test rows, run directory {run_dir}')
+
+    best = search(name, models, jobs or os.cpu_count(), run_dir, log)
+    y_test = y[test_rows]
+    summary = {}
+    for model, params in best.items():
+        estimator = base_estimator(name, model).set_params(**params)
+        estimator.fit(_frame(X, train_rows, columns, estimator), y[train_rows])
+        predicted = estimator.predict(_frame(X, test_rows, columns, estimator))
+        path = MODEL_PATHS[name][model]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(estimator, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        artifact, note = export(path)
+        summary[model] = {'params': params, 'rmse': float(np.sqrt(mean_squared_error(y_test, predicted))),
+                          'r2': float(r2_score(y_test, predicted)), 'path': path}
+        log(f"  {model}: test rmse {summary[model]['rmse']:.1f}, r2 {summary[model]['r2']:.4f} -> {path} ({note})")
+    with open(os.path.join(run_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search and retrain the prediction models')
+    parser.add_argument('names', nargs='*', help=f"datasets to train, {' and '.join(SOURCES)} by default")
+    parser.add_argument('--models', nargs='+', help='only these models, e.g. random_forest')
+    parser.add_argument('--jobs', type=int, help='worker processes, all cores by default')
+    parser.add_argument('--fresh', action='store_true', help='ignore fold results cached by earlier runs')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in SOURCES]
+    if unknown:
+        parser.error(f"unknown dataset(s): {', '.join(unknown)}")
+
+    for name in args.names or SOURCES:
+        models = [model for model in args.models or SEARCHES[name] if model in SEARCHES[name]]
+        if models:
+            start = time.perf_counter()
+            train(name, models, args.jobs, args.fresh)
+            print(f'{name}: done in {time.perf_counter() - start:.0f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+# Listing fields converted the way the notebooks do, shared by the training matrix and the predict pages. Columns are
+# handled as categoricals: each distinct string is parsed once and the result mapped back through the codes, so a
+# column of millions of rows costs a few dozen parses and one take.
+
+FLAT_TYPES = {'2-ROOM': 1, '3-ROOM': 2, '4-ROOM': 3, '5-ROOM': 4, 'EXECUTIVE': 5, 'MULTI-GENERATION': 6}
+
+FLAT_MODELS = ['3Gen', 'Apartment', 'Improved-Maisonette', 'Maisonette', 'Model A', 'Model A-Maisonette', 'New Generation', 'Premium Apartment Loft', 'Premium Maisonette', 'Special', 'Standard']
+
+# the notebooks' flat_model grouping
+FLAT_MODEL_REPLACEMENTS = {'Executive Maisonette': 'Maisonette', 'Terrace': 'Special', 'Adjoined flat': 'Special',
+                           'Type S1S2': 'Special', 'DBSS': 'Special', 'Model A2': 'Model A', 'Premium Apartment': 'Apartment',
+                           'Improved': 'Standard', 'Simplified': 'Model A', '2-room': 'Standard'}
+
+# case-insensitive, the 1990s files spell flat models in capitals
+FLAT_MODEL_LOOKUP = {**{model.lower(): model for model in FLAT_MODELS},
+                     **{raw.lower(): model for raw, model in FLAT_MODEL_REPLACEMENTS.items()}}
+
+
+def parse_storey_range(value):
+    # '10 TO 12' -> 11 as the notebooks compute it, numbers pass through, NaN otherwise
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        low, high = str(value).split(' TO ')
+        return float((int(low) + int(high)) // 2)
+    except ValueError:
+        return np.nan
+
+
+def parse_flat_type(value):
+    # '3 ROOM' (resale files) and '3-ROOM' (rental files) -> 2, NaN for types the models were not trained on
+    return FLAT_TYPES.get(str(value).strip().upper().replace(' ', '-'), np.nan)
+
+
+def parse_flat_model(value):
+    return FLAT_MODEL_LOOKUP.get(str(value).strip().lower())
+
+
+def _per_category(values, parse, missing):
+    # parse every category once and take the results through the codes, missing values (code -1) map to missing
+    values = pd.Categorical(values)
+    parsed = [parse(category) for category in values.categories] + [missing]
+    return np.array(parsed, dtype=object if missing is None else float)[values.codes]
+
+
+def storey_midpoint(values):
+    return _per_category(values, parse_storey_range, np.nan)
+
+
+def flat_type_ordinal(values):
+    return _per_category(values, parse_flat_type, np.nan)
+
+
+def normalise_flat_model(values):
+    # the notebooks' flat model names, None where a value has no counterpart
+    return _per_category(values, parse_flat_model, None)
+
+
+# per column: the vectorized conversion the encoders apply to a frame of listings, and its single-value counterpart
+COLUMN_PARSERS = {
+    'storey_range': (storey_midpoint, parse_storey_range),
+    'flat_type': (flat_type_ordinal, parse_flat_type),
+    'flat_model': (normalise_flat_model, parse_flat_model),
+}
@@ -0,0 +1,226 @@
+import json
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import AdaBoostRegressor, ExtraTreesRegressor, RandomForestRegressor, StackingRegressor, VotingRegressor
+from sklearn.linear_model import ElasticNet, Lasso, LinearRegression, Ridge
+from sklearn.tree import DecisionTreeRegressor, ExtraTreeRegressor
+
+# Flattened inference for the tree ensembles behind the predict pages. Every tree of a model is copied into one set
+# of contiguous node arrays and all (row, tree) pairs descend together, one vectorized step per tree level, instead
+# of sklearn predicting estimator by estimator. Compiled models keep the predict(X) interface of the originals, so
+# they can stand in for them anywhere, and hold nothing but plain arrays so their artifact can be memory-mapped.
+#
+# Splits follow the libraries exactly: features are compared as float32, sklearn sends x <= threshold left and
+# XGBoost x < threshold, stored here as x <= the next float32 below it. Inputs with NaN are refused, the listing
+# encoders never produce them.
+
+XGBOOST_IDENTITY_OBJECTIVES = ['reg:squarederror', 'reg:squaredlogerror', 'reg:pseudohubererror', 'reg:absoluteerror']
+
+
+class Trees:
+    # Node arrays of all the trees in one model. children holds (right, left) global node indices interleaved so the
+    # next node is children[2 * node + went_left]; thresholds are rounded down to float32, which keeps x <= threshold
+    # exact for float32 features while halving their size.
+    def __init__(self, trees):
+        sizes = [len(left) for _, _, left, _, _ in trees]
+        self.roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int32)
+        self.feature = np.concatenate([np.where(left < 0, 0, feature) for feature, _, left, _, _ in trees]).astype(np.int32)
+        threshold = np.concatenate([threshold for _, threshold, _, _, _ in trees]).astype(np.float64)
+        rounded = threshold.astype(np.float32)
+        self.threshold = np.where(rounded > threshold, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+        left = np.concatenate([np.where(left < 0, -1, left + offset) for (_, _, left, _, _), offset in zip(trees, self.roots)])
+        right = np.concatenate([np.where(right < 0, -1, right + offset) for (_, _, _, right, _), offset in zip(trees, self.roots)])
+        self.children = np.column_stack([right, left]).ravel().astype(np.int32)
+        self.internal = left >= 0
+        self.value = np.concatenate([value for _, _, _, _, value in trees]).astype(np.float64)
+
+    def leaf_values(self, X):
+        # (rows, trees) leaf values. (tree, row) pairs are laid out tree by tree so neighbouring pairs read the same
+        # nodes, and a pair drops out of the active set as soon as it reaches a leaf
+        n_rows, n_features = X.shape
+        flat = X.astype(np.float32).ravel()
+        nodes = np.repeat(self.roots, n_rows)
+        active = np.flatnonzero(self.internal[nodes])
+        current = nodes[active]
+        row_offsets = active % n_rows * n_features
+        while active.size:
+            went_left = flat[row_offsets + self.feature[current]] <= self.threshold[current]
+            current = self.children[2 * current + went_left]
+            internal = self.internal[current]
+            nodes[active[~internal]] = current[~internal]
+            active, current, row_offsets = active[internal], current[internal], row_offsets[internal]
+        return self.value[nodes].reshape(len(self.roots), n_rows).T
+
+    def split_thresholds(self, feature):
+        return self.threshold[self.internal & (self.feature == feature)]
+
+
+class CompiledModel:
+    feature_names_in_ = None
+    n_features_in_ = None
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if not np.isfinite(X).all():
+            raise ValueError('Input contains NaN or infinity')
+        return self._predict(X)
+
+
+class CompiledForest(CompiledModel):
+    def __init__(self, trees):
+        self.trees = trees
+
+    def _predict(self, X):
+        # summed in tree order like sklearn, then averaged
+        values = self.trees.leaf_values(X)
+        return values.cumsum(axis=1)[:, -1] / values.shape[1]
+
+
+class CompiledAdaBoost(CompiledModel):
+    def __init__(self, trees, weights):
+        self.trees = trees
+        self.weights = weights
+
+    def _predict(self, X):
+        # weighted median of the tree predictions, as AdaBoostRegressor._get_median_predict
+        predictions = self.trees.leaf_values(X)
+        sorted_index = np.argsort(predictions, axis=1)
+        weight_cdf = np.cumsum(self.weights[sorted_index], axis=1)
+        median_or_above = weight_cdf >= 0.5 * weight_cdf[:, -1][:, None]
+        rows = np.arange(len(X))
+        return predictions[rows, sorted_index[rows, median_or_above.argmax(axis=1)]]
+
+
+class CompiledXGBoost(CompiledModel):
+    def __init__(self, trees, base_score):
+        self.trees = trees
+        self.base_score = base_score
+
+    def _predict(self, X):
+        # accumulated in float32 from the base score, like the XGBoost CPU predictor
+        values = self.trees.leaf_values(X).astype(np.float32)
+        margins = np.column_stack([np.full(len(X), self.base_score, dtype=np.float32), values])
+        return margins.cumsum(axis=1, dtype=np.float32)[:, -1]
+
+
+class CompiledLinear(CompiledModel):
+    def __init__(self, coef, intercept):
+        self.coef = coef
+        self.intercept = intercept
+
+    def _predict(self, X):
+        return X @ self.coef + self.intercept
+
+
+class CompiledVoting(CompiledModel):
+    def __init__(self, models, weights):
+        self.models = models
+        self.weights = weights
+
+    def _predict(self, X):
+        return np.average(np.column_stack([model._predict(X) for model in self.models]), axis=1, weights=self.weights)
+
+
+class CompiledStacking(CompiledModel):
+    def __init__(self, models, final, passthrough):
+        self.models = models
+        self.final = final
+        self.passthrough = passthrough
+
+    def _predict(self, X):
+        stacked = np.column_stack([model._predict(X) for model in self.models] + ([X] if self.passthrough else []))
+        return self.final._predict(stacked)
+
+
+def _sklearn_trees(estimators):
+    return Trees([(t.feature, t.threshold, t.children_left, t.children_right, t.value[:, 0, 0])
+                  for t in (estimator.tree_ for estimator in estimators)])
+
+
+def _xgboost_trees(model):
+    booster = model.get_booster()
+    config = json.loads(booster.save_config())['learner']
+    if config['objective']['name'] not in XGBOOST_IDENTITY_OBJECTIVES or config['gradient_booster']['name'] != 'gbtree':
+        raise NotImplementedError(f"XGBoost {config['gradient_booster']['name']} models with {config['objective']['name']}")
+    learner = json.loads(booster.save_raw('json'))['learner']
+    trees = learner['gradient_booster']['model']['trees']
+    if learner['learner_model_param'].get('num_target', '1') != '1' or any(any(t['split_type']) for t in trees):
+        raise NotImplementedError('XGBoost models with several targets or categorical splits')
+    try:
+        # predict() stops at the best iteration when the model was fit with early stopping
+        trees = trees[:learner['gradient_booster']['model']['iteration_indptr'][model.best_iteration + 1]]
+    except AttributeError:
+        pass
+
+    flattened = []
+    for tree in trees:
+        left, right = np.array(tree['left_children']), np.array(tree['right_children'])
+        conditions = np.array(tree['split_conditions'], dtype=np.float32)
+        below = np.nextafter(conditions, np.float32(-np.inf))
+        flattened.append((np.array(tree['split_indices']), below, left, right, conditions))
+    return Trees(flattened), np.float32(learner['learner_model_param']['base_score'].strip('[]'))
+
+
+def _compile(model):
+    if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)):
+        return CompiledForest(_sklearn_trees(model.estimators_))
+    if isinstance(model, (DecisionTreeRegressor, ExtraTreeRegressor)):
+        return CompiledForest(_sklearn_trees([model]))
+    if isinstance(model, AdaBoostRegressor):
+        estimators = model.estimators_
+        if not all(isinstance(estimator, DecisionTreeRegressor) for estimator in estimators):
+            raise NotImplementedError('AdaBoostRegressor over non-tree estimators')
+        return CompiledAdaBoost(_sklearn_trees(estimators), model.estimator_weights_[:len(estimators)].astype(np.float64))
+    if isinstance(model, (LinearRegression, Ridge, Lasso, ElasticNet)) and np.ndim(model.coef_) == 1:
+        return CompiledLinear(np.asarray(model.coef_, dtype=np.float64), float(model.intercept_))
+    if isinstance(model, VotingRegressor):
+        return CompiledVoting([_compile(estimator) for estimator in model.estimators_], model._weights_not_none)
+    if isinstance(model, StackingRegressor):
+        if any(method != 'predict' for method in model.stack_method_):
+            raise NotImplementedError('StackingRegressor with a stack method other than predict')
+        return CompiledStacking([_compile(estimator) for estimator in model.estimators_ if estimator != 'drop'],
+                                _compile(model.final_estimator_), model.passthrough)
+    if type(model).__module__.startswith('xgboost') and hasattr(model, 'get_booster'):
+        return CompiledXGBoost(*_xgboost_trees(model))
+    raise NotImplementedError(type(model).__name__)
+
+
+def compile_model(model):
+    # raises NotImplementedError for models (or parts of models) that have no flattened equivalent
+    compiled = _compile(getattr(model, 'best_estimator_', model))
+    compiled.feature_names_in_ = getattr(model, 'feature_names_in_', None)
+    compiled.n_features_in_ = model.n_features_in_
+    return compiled
+
+
+def _input_trees(model):
+    # trees that split on the model's own inputs, i.e. not a stacking final estimator
+    for name, part in vars(model).items():
+        for inner in part if isinstance(part, list) else [part]:
+            if isinstance(inner, Trees):
+                yield inner
+            elif isinstance(inner, CompiledModel) and name != 'final':
+                yield from _input_trees(inner)
+
+
+def parity_inputs(compiled, n_rows, seed=0):
+    # rows made of split thresholds and their float32 neighbours, so both sides of the splits are exercised
+    rng = np.random.default_rng(seed)
+    trees = list(_input_trees(compiled))
+    columns = []
+    for feature in range(compiled.n_features_in_):
+        thresholds = np.concatenate([[0., 1.], *[t.split_thresholds(feature) for t in trees]]).astype(np.float32)
+        picked = rng.choice(thresholds, n_rows)
+        step = rng.choice([-np.inf, 0, np.inf], n_rows).astype(np.float32)
+        columns.append(np.where(step == 0, picked, np.nextafter(picked, step)))
+    return np.column_stack(columns).astype(np.float64)
+
+
+def check_parity(model, compiled, n_rows=2000, rtol=1e-6):
+    # largest absolute difference between the original and compiled predictions, and whether it is within rtol
+    X = parity_inputs(compiled, n_rows)
+    if compiled.feature_names_in_ is not None:
+        X = pd.DataFrame(X, columns=compiled.feature_names_in_)
+    expected, actual = model.predict(X), compiled.predict(X)
+    return float(np.abs(expected - actual).max()), bool(np.allclose(expected, actual, rtol=rtol, atol=0))
@@ -1,15 +1,16 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime as dt, timedelta
-import geopandas as gpd
-from streamlit_folium import folium_static
-from custom_scripts.heatmap import heatmap
+from datetime import timedelta
+from custom_scripts.heatmap import show_heatmap
+from custom_scripts.datastore import load_resale_cube, load_resale_density, month_ordinal, month_start, month_range, to_period_index, MONTH_ABBR
+from custom_scripts.cube import slice_cells, rollup, density_grid, lease_segment_labels
+from custom_scripts.charts import chart_backend, show_chart
+from custom_scripts.instrument import finish_rerun, start_rerun
 
 PLOT_COLOR = (246/255, 51/255, 102/255)
 PLOT_COLOR_BLUE= (30/255, 144/255, 255/255)
 
 st.set_page_config(layout='wide', initial_sidebar_state='expanded')
+start_rerun('HDB Resales')
 
 st.title('Trends among HDB Resales in Singapore')
 
@@ -22,34 +23,16 @@ aggregator = st.sidebar.radio(
     index=0,
     horizontal=True
 )
-time_period_ranges = {
-    "1990-1999": (dt(year=1990, month=1, day=1), dt(year=1999, month=12, day=31)),
-    "2000-2011": (dt(year=2000, month=1, day=1), dt(year=2011, month=12, day=31)),
-    "2012-2018": (dt(year=2012, month=1, day=1), dt(year=2018, month=12, day=31)),
-    "2019-2024": (dt(year=2019, month=1, day=1), dt(year=2024, month=2, day=24)),
-}
-
-st.sidebar.subheader('Select the time period of resale data')
-
-resale_time_period = st.sidebar.radio(
-        label_visibility='collapsed',
-        label='no_label',
-        options=["***1990-1999***", "***2000-2011***", "***2012-2018***", "***2019-2024***"],
-        index=0,
-        horizontal=True).strip('*')
-
-resale_data = pd.read_csv(f'data/ResaleFlatPrices{resale_time_period}.csv')
-resale_data['month'] = pd.to_datetime(resale_data['month'])
-resale_data['month'] = resale_data['month'].dt.to_period('M')
-resale_data['remaining_lease']= (99 + resale_data['lease_commence_date']) - resale_data['month'].dt.year
-resale_data = resale_data.drop_duplicates()
-
-all_flat_types = sorted(resale_data['flat_type'].unique())
+
+resale_cells, _ = load_resale_cube()
+resale_density_cells = load_resale_density()
+
+all_flat_types = sorted(resale_cells['flat_type'].unique())
 
 st.sidebar.subheader('Filter on any of these parameters')
 flat_types = st.sidebar.multiselect('Select flat type(s)', all_flat_types, all_flat_types)
 
-start_date, end_date = time_period_ranges[resale_time_period]
+start_date, end_date = [month_start(m) for m in month_range('resale')]
 time = st.sidebar.slider(key='time', 
                          label='Select period of time', 
                          format="MMM 'YY", 
@@ -58,164 +41,81 @@ time = st.sidebar.slider(key='time',
                          step=timedelta(days=30), 
                          value=(start_date, end_date))
 
-resale_data_modified = resale_data[resale_data['flat_type'].isin(flat_types)]
-
-time_filter_start, time_filter_end = pd.to_datetime(time[0]).to_period('M'), pd.to_datetime(time[1]).to_period('M')
+time_filter_start, time_filter_end = month_ordinal(time[0]), month_ordinal(time[1])
 
-resale_data_date_filtered = resale_data_modified[(resale_data_modified['month'] >= time_filter_start) & (resale_data_modified['month'] <= time_filter_end)]
+backend = chart_backend()
 
-map_data = gpd.read_file('data/MasterPlan2019PlanningAreaBoundaryNoSea.geojson')
+resale_cells_filtered = slice_cells(resale_cells, 'month', flat_types, time_filter_start, time_filter_end)
+lease_cells = resale_cells_filtered[resale_cells_filtered['lease_segment'] >= 0]
 
 if aggregator == '***Average Resale Price***':
     if flat_types:
-        resale_data_rates_grouped_by_time = resale_data_date_filtered.groupby('month')['resale_price'].mean()
+        resale_data_rates_grouped_by_time = rollup(resale_cells_filtered, 'month')['mean']
+        resale_data_rates_grouped_by_time.index = to_period_index(resale_data_rates_grouped_by_time.index)
         if time_filter_end != time_filter_start:
-            fig1 = plt.figure(figsize=(20,10))
-            resale_data_rates_grouped_by_time.plot(color='red')
-            plt.title('Time Period Wise Trends')
-            plt.xlabel('Resale Period')
-            plt.ylabel('Resale Prices (SGD)')
-            plt.grid(linestyle='--')
-            plt.scatter(resale_data_date_filtered['month'], resale_data_date_filtered['resale_price'], color='lightblue')
-            st.pyplot(fig1)
+            resale_density = density_grid(slice_cells(resale_density_cells, 'month', flat_types, time_filter_start, time_filter_end), 'month', 'resale_price')
+            show_chart('line', resale_data_rates_grouped_by_time, backend, title='Time Period Wise Trends', xlabel='Resale Period',
+                       ylabel='Resale Prices (SGD)', color='red', figsize=(20, 10), density=resale_density)
         else:
             st.error('Line plot does not exist for the filtered time period')
         
         colx, coly, colz = st.columns([0.5,1,0.5])
-        avg_resale_by_town_plot = resale_data_date_filtered.groupby('town')['resale_price'].mean().sort_values()
+        avg_resale_by_town_plot = rollup(resale_cells_filtered, 'town')['mean'].sort_values()
         with coly:
-            town_df = pd.DataFrame()
-            town_df['PLN_AREA_N'] = avg_resale_by_town_plot.index
-            town_df['resale_price'] = avg_resale_by_town_plot.values
-
-            map_data = pd.merge(left=map_data, right=town_df, on='PLN_AREA_N', how='left')
-            resale_heatmap = heatmap(map_data, 'resale_price')
-            folium_static(resale_heatmap)
+            show_heatmap(avg_resale_by_town_plot, 'resale_price')
             
         col1, col2 = st.columns([0.55, 0.45])
         with col1:
-            fig2 = plt.figure(figsize=(10, 15))
-            avg_resale_by_town_plot.plot(kind='barh', color='g')
-            plt.title('Town Wise Trends')
-            plt.xlabel('Average Resale (SGD)')
-            plt.xlim(min(avg_resale_by_town_plot.values)-100, max(avg_resale_by_town_plot.values)+100)
-            plt.ylabel('Town')
-            plt.grid(linestyle='--')
-
-            st.pyplot(fig2)
-
-            resale_data_date_filtered['lease_segment'] = pd.cut(resale_data_date_filtered['remaining_lease'], 
-                                                    bins=range(0, 105, 5), 
-                                                    labels=[f"{i}-{i+4}" for i in range(0, 100, 5)])
-            avg_price_by_lease_segment = resale_data_date_filtered.groupby('lease_segment')['resale_price'].mean().sort_index()
-            avg_price_by_lease_segment = avg_price_by_lease_segment.dropna()
-            fig7 = plt.figure(figsize=(10, 5.8))
-            avg_price_by_lease_segment.plot(kind='bar', color=PLOT_COLOR_BLUE)
-            plt.title('Average Resale Price by Remaining Lease Segment')
-            plt.xlabel('Remaining Lease (Years)')
-            plt.ylabel('Average Resale Price (SGD)')
-            plt.grid(linestyle='--')
-            st.pyplot(fig7)
+            show_chart('barh', avg_resale_by_town_plot, backend, title='Town Wise Trends', xlabel='Average Resale (SGD)', ylabel='Town',
+                       color='g', figsize=(10, 15), xlim=(min(avg_resale_by_town_plot.values)-100, max(avg_resale_by_town_plot.values)+100))
+
+            avg_price_by_lease_segment = rollup(lease_cells, 'lease_segment')['mean'].sort_index()
+            avg_price_by_lease_segment.index = lease_segment_labels(avg_price_by_lease_segment.index)
+            show_chart('bar', avg_price_by_lease_segment, backend, title='Average Resale Price by Remaining Lease Segment',
+                       xlabel='Remaining Lease (Years)', ylabel='Average Resale Price (SGD)', color=PLOT_COLOR_BLUE)
         with col2:
-            resale_data_month_year = resale_data_date_filtered
-            resale_data_month_year['month'] = [x.strftime('%b') for x in resale_data_month_year['month']]
-            months = resale_data_month_year['month'].unique()
-            avg_resale_by_month_plot = resale_data_month_year.groupby('month')['resale_price'].mean().sort_index()
-
-            fig3 = plt.figure(figsize=(10, 5.8))
-            avg_resale_by_month_plot.plot(kind='bar', color='c')
-            plt.title('Month Wise Trends')
-            plt.xlabel('Month')
-            plt.ylabel('Average Resale (SGD)')
-            plt.xticks(ticks=range(len(months)), labels=months, rotation=45)
-            plt.grid(linestyle='--')
-
-            st.pyplot(fig3)
-
-            avg_rent_by_flat_type_plot = resale_data_date_filtered.groupby('flat_type')['resale_price'].mean().sort_index()
-            fig4 = plt.figure(figsize=(10, 5.8))
-            avg_rent_by_flat_type_plot.plot(kind='bar', color=PLOT_COLOR)
-            plt.title('Flat Type Wise Trends')
-            plt.xlabel('Flat Type')
-            plt.ylabel('Average Resale Price (SGD)')
-            plt.grid(linestyle='--')
-
-            st.pyplot(fig4)
+            avg_resale_by_month_plot = rollup(resale_cells_filtered, resale_cells_filtered['month'] % 12)['mean'].sort_index()
+            avg_resale_by_month_plot.index = [MONTH_ABBR[m] for m in avg_resale_by_month_plot.index]
+            show_chart('bar', avg_resale_by_month_plot, backend, title='Month Wise Trends', xlabel='Month', ylabel='Average Resale (SGD)',
+                       color='c', rotation=45)
+
+            avg_rent_by_flat_type_plot = rollup(resale_cells_filtered, 'flat_type')['mean'].sort_index()
+            show_chart('bar', avg_rent_by_flat_type_plot, backend, title='Flat Type Wise Trends', xlabel='Flat Type',
+                       ylabel='Average Resale Price (SGD)', color=PLOT_COLOR)
     else:
         st.error('Filter at least one flat type to visualize!')
 else:
     if flat_types:
         if time_filter_end != time_filter_start:
-            rental_transactions_with_time = resale_data_date_filtered.groupby('month').size()
-            fig5 = plt.figure(figsize=(20,10))
-            rental_transactions_with_time.plot()
-            plt.title('Resale Transactions Performed Over Time')
-            plt.ylabel('Number of transactions')
-            plt.xlabel('Resale Period')
-            plt.grid(linestyle='--')
-
-            st.pyplot(fig5)
+            rental_transactions_with_time = rollup(resale_cells_filtered, 'month')['count']
+            rental_transactions_with_time.index = to_period_index(rental_transactions_with_time.index)
+            show_chart('line', rental_transactions_with_time, backend, title='Resale Transactions Performed Over Time',
+                       xlabel='Resale Period', ylabel='Number of transactions', figsize=(20, 10))
             colx, coly = st.columns(2)
-            transactions_by_town_plot = resale_data_date_filtered.groupby('town').size().sort_values()
+            transactions_by_town_plot = rollup(resale_cells_filtered, 'town')['count'].sort_values()
             with colx:
-                town_df = pd.DataFrame()
-                town_df['PLN_AREA_N'] = transactions_by_town_plot.index
-                town_df['count'] = transactions_by_town_plot.values
-
-                map_data = pd.merge(left=map_data, right=town_df, on='PLN_AREA_N', how='left')
-                count_heatmap = heatmap(map_data, 'count')
-                folium_static(count_heatmap)
+                show_heatmap(transactions_by_town_plot, 'count')
             
             with coly:
-                transactions_by_flat_type_plot = resale_data_date_filtered.groupby('flat_type').size().sort_values()
-
-                fig6 = plt.figure(figsize=(10, 5.8))
-                transactions_by_flat_type_plot.plot(kind='pie', autopct='%1.0f%%', ylabel=None)
-                plt.title('Percentage of Resale Transactions for Different Flat Types')
-                plt.ylabel('')
+                transactions_by_flat_type_plot = rollup(resale_cells_filtered, 'flat_type')['count'].sort_values()
 
-                st.pyplot(fig6)
+                show_chart('pie', transactions_by_flat_type_plot, backend, title='Percentage of Resale Transactions for Different Flat Types')
             
             col1, col2 = st.columns([0.55, 0.45])
             with col1:
-                fig2 = plt.figure(figsize=(10, 15))
-                transactions_by_town_plot.plot(kind='barh', color='g')
-                plt.title('Town Wise Trends')
-                plt.xlabel('Resale Transactions')
-                plt.xlim(min(transactions_by_town_plot.values)-100, max(transactions_by_town_plot.values)+100)
-                plt.ylabel('Town')
-                plt.grid(linestyle='--')
-
-                st.pyplot(fig2)
+                show_chart('barh', transactions_by_town_plot, backend, title='Town Wise Trends', xlabel='Resale Transactions', ylabel='Town',
+                           color='g', figsize=(10, 15), xlim=(min(transactions_by_town_plot.values)-100, max(transactions_by_town_plot.values)+100))
 
             with col2:
-                resale_data_month_year = resale_data_date_filtered
-                resale_data_month_year['month'] = [x.strftime('%b') for x in resale_data_month_year['month']]
-                months = resale_data_month_year['month'].unique()
-                transactions_by_town_plot = resale_data_month_year.groupby('month').size().sort_values()
-
-                fig3 = plt.figure(figsize=(10, 5.8))
-                transactions_by_town_plot.plot(kind='bar', color='c')
-                plt.title('Month Wise Trends')
-                plt.xlabel('Month')
-                plt.ylabel('Resale Transactions')
-                plt.xticks(ticks=range(len(months)), labels=months, rotation=45)
-                plt.grid(linestyle='--')
-
-                st.pyplot(fig3)
-
-                resale_data_date_filtered['lease_segment'] = pd.cut(resale_data_date_filtered['remaining_lease'], 
-                                                    bins=range(0, 105, 5), 
-                                                    labels=[f"{i}-{i+4}" for i in range(0, 100, 5)])
-                transaction_counts = resale_data_date_filtered.groupby('lease_segment').size()
-                transaction_counts = transaction_counts[transaction_counts > 0]
-                fig8, ax = plt.subplots(figsize=(10, 5.8))
-                transaction_counts.plot(kind='bar', color=PLOT_COLOR_BLUE, ax=ax)
-                ax.set_title('Number of Resale Transactions by Remaining Lease')
-                ax.set_xlabel('Remaining Lease (Years)')
-                ax.set_ylabel('Number of Transactions')
-                ax.grid(linestyle='--')
-                st.pyplot(fig8)
+                transactions_by_town_plot = rollup(resale_cells_filtered, resale_cells_filtered['month'] % 12)['count'].sort_values()
+                transactions_by_town_plot.index = [MONTH_ABBR[m] for m in transactions_by_town_plot.index]
+                show_chart('bar', transactions_by_town_plot, backend, title='Month Wise Trends', xlabel='Month', ylabel='Resale Transactions',
+                           color='c', rotation=45)
+
+                transaction_counts = rollup(lease_cells, 'lease_segment')['count'].sort_index()
+                transaction_counts.index = lease_segment_labels(transaction_counts.index)
+                show_chart('bar', transaction_counts, backend, title='Number of Resale Transactions by Remaining Lease',
+                           xlabel='Remaining Lease (Years)', ylabel='Number of Transactions', color=PLOT_COLOR_BLUE)
 
         else:
             st.error('Filter a finite time period')
@@ -225,4 +125,6 @@ else:
 st.sidebar.markdown('''
 ---
 Data taken from https://beta.data.gov.sg/. 
-''')
\ No newline at end of file
+''')
+
+finish_rerun()
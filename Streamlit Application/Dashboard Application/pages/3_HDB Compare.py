@@ -1,27 +1,48 @@
+import io
 import streamlit as st
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
+import numpy as np
 import matplotlib.patches as mpatches
-import seaborn as sns
+from matplotlib.figure import Figure
+from custom_scripts.charts import SAVEFIG_OPTIONS, chart_backend, show_chart
+from custom_scripts.cube import binned_kde, rollup, scott_bandwidth, sketch_histogram, sketch_quantile, sketch_rebin
+from custom_scripts.datastore import MONTH_COLUMNS, load_cube, month_range, ordinal_year
+from custom_scripts.geometry import plot_planning_areas
+from custom_scripts.instrument import finish_rerun, start_rerun
 
 
-map_data = gpd.read_file('data/MasterPlan2019PlanningAreaBoundaryNoSea.geojson')
-map_data.rename(columns={'PLN_AREA_N': 'town'})
-
 METRIC_MAP = {
     'monthly_rent': 'Monthly Rent',
     'resale_price': 'Resale Price'
 }
 
+# multiples of the sketch's bins, see custom_scripts.cube.SKETCH_BIN_WIDTH
 BIN_WIDTH_MAP = {
     'monthly_rent': 500,
     'resale_price': 20000
 }
 
-data = pd.DataFrame()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def town_map(townA, townB):
+    fig = Figure()
+    ax = fig.subplots()
+    plot_planning_areas(ax, {townA: 'red', townB: 'blue'})
+    ax.set_axis_off()
+    townA_patch, townB_patch = mpatches.Patch(color='red', label=townA), mpatches.Patch(color='blue', label=townB)
+    handles, labels = ax.get_legend_handles_labels()
+    handles.append(townA_patch)
+    labels.append(townA)
+    handles.append(townB_patch)
+    labels.append(townB)
+    ax.legend(handles, labels, loc='lower center', bbox_to_anchor=(0.5, -0.05), fancybox=True, shadow=True, ncol=3)
+    image = io.BytesIO()
+    fig.savefig(image, **SAVEFIG_OPTIONS)
+    return image.getvalue()
+
 
 st.set_page_config(layout='wide', initial_sidebar_state='expanded')
+start_rerun('HDB Compare')
 
 st.title('Compare HDBs across towns')
 
@@ -31,28 +52,28 @@ trend = st.radio(
         index=0,
         horizontal=True)
 
-metric = 'monthly_rent'
-
+# every statistic below is merged from the per-(town, month, flat_type) moments and the per-(town, flat_type, year)
+# price histograms built at ingest, never from the transactions themselves
 if trend == '***Rental Trends***':
-    data = pd.read_csv('data/RentingOutOfFlats.csv')
-    data['rent_approval_date'] = pd.to_datetime(data['rent_approval_date'])
-    data['rent_approval_date'] = data['rent_approval_date'].dt.to_period('M')
+    name, metric = 'rental', 'monthly_rent'
+    cells, sketch = load_cube(name)
 else:
-    resale_time_period = st.radio(
+    name, metric = 'resale', 'resale_price'
+    cells, sketch = load_cube(name)
+    first_year, last_year = [ordinal_year(m) for m in month_range('resale')]
+    start_year, end_year = st.slider(
         label='Select time period of resale data to visualize',
-        options=["***1990-1999***", "***2000-2011***", "***2012-2018***", "***2019-2024***"],
-        index=0,
-        horizontal=True).strip('*')
-    data = pd.read_csv(f'data/ResaleFlatPrices{resale_time_period}.csv')
-    data['month'] = pd.to_datetime(data['month'])
-    data['month'] = data['month'].dt.to_period('M')
-    metric = 'resale_price'
+        min_value=first_year,
+        max_value=last_year,
+        value=(first_year, last_year))
+    # whole years of month ordinals, the histograms are kept per year
+    cells = cells[cells[MONTH_COLUMNS[name]].between((start_year - 1970) * 12, (end_year - 1970) * 12 + 11)]
+    sketch = sketch[sketch['year'].between(start_year, end_year)]
 
-data['selected'] = False
-data = data.drop_duplicates()
+backend = chart_backend()
 
-all_towns = sorted(data['town'].unique())
-all_flat_types = sorted(data['flat_type'].unique())
+all_towns = sorted(cells['town'].unique())
+all_flat_types = sorted(cells['flat_type'].unique())
 
 col1, col2 = st.columns(2)
 with col1:
@@ -64,53 +85,49 @@ if townA == townB:
     st.error('Filter two different towns')
 else:
     cola, colb, colc = st.columns([1,1.5,1])
-    maskA = map_data['PLN_AREA_N'] == townA
-    maskB = map_data['PLN_AREA_N'] == townB
-    fig, ax = plt.subplots()
-    map_data.plot(alpha=0.5, edgecolor='k', ax=ax)
-    ax.set_axis_off()
-    townA_patch, townB_patch = mpatches.Patch(color='red', label=townA), mpatches.Patch(color='blue', label=townB)
-    handles, labels = ax.get_legend_handles_labels()
-    handles.append(townA_patch)
-    labels.append(townA)
-    handles.append(townB_patch)
-    labels.append(townB)
-    ax.legend(handles, labels, loc='lower center', bbox_to_anchor=(0.5, -0.05), fancybox=True, shadow=True, ncol=3)
-    map_data[maskA].plot(ax=ax, color='red', legend=True, legend_kwds={'label': "Town A"})
-    map_data[maskB].plot(ax=ax, color='blue', legend=True, legend_kwds={'label': "Town B"})
     with colb:
-        st.pyplot(fig)
+        st.image(town_map(townA, townB))
     colx, coly, colz = st.columns([1,3,1])
     with coly:
         flat_types = st.multiselect('Select flat type(s)', all_flat_types, all_flat_types)
     if flat_types:
-        col3, col4, col5, col6 = st.columns([4,1,1,4])
-        data_modified = data[data['flat_type'].isin(flat_types)]
-        with col3:
-            townA_df = data_modified[data_modified['town'] == townA]
-            st.subheader(townA)
-            st.metric(label=f"Average {METRIC_MAP[metric]}", value='SGD ' + str(round(townA_df[metric].mean())))
-            st.metric(label=f"Median {METRIC_MAP[metric]}", value='SGD ' + str(round(townA_df[metric].median())))
-            st.metric(label=f"{METRIC_MAP[metric]} Range", value='SGD ' + str(townA_df[metric].min()) + ' to SGD ' + str(townA_df[metric].max()) )
-            st.metric(label="Number of transactions", value=townA_df.shape[0])
-        with col6:
-            townB_df = data_modified[data_modified['town'] == townB]
-            st.subheader(townB)
-            st.metric(label=f"Average {METRIC_MAP[metric]}", value='SGD ' + str(round(townB_df[metric].mean())))
-            st.metric(label=f"Median {METRIC_MAP[metric]}", value='SGD ' + str(round(townB_df[metric].median())))
-            st.metric(label=f"{METRIC_MAP[metric]} Range", value='SGD ' + str(townB_df[metric].min()) + ' to SGD ' + str(townB_df[metric].max()) )
-            st.metric(label="Number of transactions", value=townB_df.shape[0])
-        col7, col8, col9 = st.columns([1,3,1])
-        with col8:
-            figy, ax = plt.subplots()
-            histo = sns.histplot(data=data_modified, x=metric, hue="town", hue_order=[townA, townB], binwidth=BIN_WIDTH_MAP[metric], kde=True, element="step")
-            plt.title(f'Distribution of HDBs with Different Ranges of {METRIC_MAP[metric]}')
-            plt.xlabel(f'{METRIC_MAP[metric]} (SGD)')
-            plt.ylabel('Number of HDBs')
-            st.pyplot(figy)
+        towns = [townA, townB]
+        totals = rollup(cells[cells['town'].isin(towns) & cells['flat_type'].isin(flat_types)], 'town')
+        sketch_modified = sketch[sketch['town'].isin(towns) & sketch['flat_type'].isin(flat_types)]
+        histograms = {town: sketch_histogram(sketch_modified[sketch_modified['town'] == town]) for town in towns}
+        missing = [town for town in towns if town not in totals.index]
+        if missing:
+            st.error(f"No transactions in {' and '.join(missing)} for the selected flat type(s).")
+        else:
+            col3, col4, col5, col6 = st.columns([4,1,1,4])
+            for town, col in [(townA, col3), (townB, col6)]:
+                with col:
+                    st.subheader(town)
+                    st.metric(label=f"Average {METRIC_MAP[metric]}", value='SGD ' + str(round(totals.loc[town, 'mean'])))
+                    st.metric(label=f"Median {METRIC_MAP[metric]}", value='SGD ' + str(round(sketch_quantile(histograms[town], metric, 0.5))))
+                    st.metric(label=f"{METRIC_MAP[metric]} Range", value='SGD ' + str(round(totals.loc[town, 'min'])) + ' to SGD ' + str(round(totals.loc[town, 'max'])))
+                    st.metric(label="Number of transactions", value=int(totals.loc[town, 'count']))
+            col7, col8, col9 = st.columns([1,3,1])
+            with col8:
+                counts = pd.DataFrame({town: sketch_rebin(histograms[town], metric, BIN_WIDTH_MAP[metric]) for town in towns}).sort_index().fillna(0)
+                # the KDE scaled to transactions per histogram bin, as histplot(stat='count', kde=True) draws it, which
+                # skips a town with fewer than two transactions
+                curves = {}
+                for town in towns:
+                    if totals.loc[town, 'count'] < 2 or not np.isfinite(totals.loc[town, 'std']):
+                        continue
+                    bandwidth = scott_bandwidth(totals.loc[town, 'count'], totals.loc[town, 'std'])
+                    x, density = binned_kde(histograms[town], metric, bandwidth)
+                    curves[town] = pd.Series(density * totals.loc[town, 'count'] * BIN_WIDTH_MAP[metric], index=x)
+                kde = pd.DataFrame(curves, columns=towns).sort_index()
+                show_chart('hist', counts, backend, title=f'Distribution of HDBs with Different Ranges of {METRIC_MAP[metric]}',
+                           xlabel=f'{METRIC_MAP[metric]} (SGD)', ylabel='Number of HDBs', figsize=(6.4, 4.8),
+                           bin_width=BIN_WIDTH_MAP[metric], legend='town', kde=kde)
     else:
         st.error('Select at least one flat type to compare the towns.')
 
 st.sidebar.markdown('''
 Data taken from https://beta.data.gov.sg/. 
-''')
\ No newline at end of file
+''')
+
+finish_rerun()
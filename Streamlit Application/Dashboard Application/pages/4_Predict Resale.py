@@ -1,71 +1,92 @@
 import streamlit as st
 import pandas as pd
-import joblib
 import numpy as np
+from custom_scripts.artifacts import load_model
+from custom_scripts.prediction import MONTHS, FLAT_TYPES, FLAT_MODELS, RESALE_TOWNS, RESALE_COLUMNS, RESALE_LISTING_COLUMNS, RESALE_MODELS, PredictionCache, create_resale_encoder, predict_batch, sweep_listings
+from custom_scripts.charts import chart_backend, show_chart
+from custom_scripts.instrument import finish_rerun, start_rerun
 
 st.set_page_config(layout='wide', initial_sidebar_state='expanded')
+start_rerun('Predict Resale')
+
+# the what-if sweep: the sale months the page offers, every storey up to the top of the tallest blocks, floor areas
+# in steps of 5 sqm and every lease commencement year the models were trained on
+SWEEP_MONTHS = pd.DataFrame([(year, month) for year in [2021, 2022, 2023, 2024] for month in range(1, 13) if year < 2024 or month <= 2], columns=['year', 'month'])
+SWEEP_STOREYS = (1, 50)
+SWEEP_FLOOR_AREA_STEP = 5
+SWEEP_FIRST_LEASE_YEAR = 1966
+SWEEP_AXES = {'storey_range': 'Storey', 'floor_area_sqm': 'Floor area (in sqm)', 'sale_month': 'Sale month'}
+# the listing fields the grid varies, left out of its cache key
+SWEEP_FIELDS = ['storey_range', 'floor_area_sqm', 'year', 'month']
 
 @st.cache_resource(show_spinner='Initializing machine learning models...')
 def load_ml_model(fileDir):
-    ml_pred = joblib.load(fileDir)
+    ml_pred = load_model(fileDir)
     return ml_pred
 
+@st.cache_resource(show_spinner='Loading street and CPI tables...')
+def load_encoder():
+    return create_resale_encoder()
+
+# one cache per process, shared by every session of the page
+@st.cache_resource
+def load_prediction_cache(_models):
+    return PredictionCache(_models, RESALE_COLUMNS)
+
 def create_df_for_prediction(town, lease_comm, flat_model, year, street, storey_range, flat_type, floor_area):
-    region = regions_mapper[town]
-    remaining_lease = (99 + lease_comm) - year
-    amenities = streets_amenities[(streets_amenities['town'] == town) & (streets_amenities['street_name'] == street)]
-    mrt_dist = amenities['mrt_dist'].iloc[0]
-    school_dist = amenities['school_dist'].iloc[0]
-    mall_dist = amenities['mall_dist'].iloc[0]
-    upcoming_mrt_dist = amenities['upcoming_mrt_dist'].iloc[0]
-    cpi = cpi_df[(cpi_df['year'] == year) & (cpi_df['month'] == months[month])]['cpi'].iloc[0]
-    month_sin = np.sin((months[month]-1)*(2.*np.pi/12))
-    month_cos = np.cos((months[month]-1)*(2.*np.pi/12))
+    features = encoder.encode_row({'town': town, 'street_name': street, 'flat_type': flat_type, 'flat_model': flat_model, 'storey_range': storey_range,
+        'floor_area_sqm': floor_area, 'lease_commence_date': lease_comm, 'year': year, 'month': MONTHS[month]})
+    return None if features is None else pd.DataFrame(features[None], columns=RESALE_COLUMNS)
 
-    reg_val = {col: 1 if col == 'region_' + region else 0 for col in prefixed_regions}
-    town_val = {col: 1 if col == 'town_' + town else 0 for col in prefixed_towns}
-    model_val = {col: 1 if col == 'model_' + flat_model else 0 for col in prefixed_models}
-    row = {'flat_type': flat_types[flat_type], 'storey_range': storey_range, 'floor_area_sqm': floor_area, 'lease_commence_date': lease_comm, 'remaining_lease': remaining_lease, 'mrt_dist': mrt_dist,
-        'school_dist': school_dist, 'mall_dist': mall_dist, 'upcoming_mrt_dist': upcoming_mrt_dist, 'cpi': cpi}
-    print(row)
-    row.update(model_val)
-    row.update(reg_val)
-    row.update(town_val)
-    row.update({'month_sin': month_sin, 'month_cos': month_cos})
-    dct = {k:[v] for k,v in row.items()}
-    return pd.DataFrame(dct)
 
+def predict_listings(listings):
+    # NaN prices for the listings that cannot be encoded, and no model call at all when none can
+    features, valid = encoder.encode(listings)
+    results = listings.reset_index(drop=True)
+    for name in resale_models:
+        results[name] = np.nan
+    if valid.any():
+        for name, values in predict_batch(resale_models, features[valid], RESALE_COLUMNS).items():
+            results.loc[valid, name] = values.round()
+    return results, valid
 
-reqd_cols = ['flat_type', 'storey_range', 'floor_area_sqm', 'lease_commence_date',
-       'remaining_lease', 'mrt_dist', 'school_dist', 'mall_dist',
-       'upcoming_mrt_dist', 'cpi', 'month_sin', 'month_cos']
 
-regions_mapper = {'ANG MO KIO':'North East', 'BEDOK':'East', 'BISHAN':'Central', 'BUKIT BATOK':'West', 'BUKIT MERAH':'Central',
-       'BUKIT PANJANG':'West', 'BUKIT TIMAH':'Central', 'CHOA CHU KANG':'West',
-       'CLEMENTI':'West', 'GEYLANG':'Central', 'HOUGANG':'North East', 'JURONG EAST':'West', 'JURONG WEST':'West',
-       'KALLANG/WHAMPOA':'Central', 'MARINE PARADE':'Central', 'PASIR RIS':'East', 'PUNGGOL':'North East',
-       'QUEENSTOWN':'Central', 'SEMBAWANG':'North', 'SENGKANG':'North East', 'SERANGOON':'North East', 'TAMPINES':'East',
-       'TOA PAYOH':'Central', 'WOODLANDS':'North', 'YISHUN':'North'}
+@st.cache_data(show_spinner='Pricing every variation of the flat...', max_entries=16)
+def price_grid(flat, storeys, floor_areas):
+    # storeys x floor areas x sale months of the flat, encoded as one matrix that each model prices in a single call.
+    # flat has no SWEEP_FIELDS, so a different storey, floor area or sale month of the same flat reuses the grid
+    grid, _ = predict_listings(sweep_listings(flat, pd.DataFrame({'storey_range': storeys}), pd.DataFrame({'floor_area_sqm': floor_areas}), SWEEP_MONTHS))
+    grid['sale_month'] = pd.PeriodIndex.from_fields(year=grid['year'], month=grid['month'], freq='M')
+    return grid
 
-prefixed_regions = ['region_Central', 'region_East', 'region_North', 'region_North East', 'region_West']
 
-months = {'January': 1, 'Febraury': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12}
+@st.cache_data(show_spinner=False, max_entries=64)
+def price_leases(listing):
+    # the listing with every lease commencement year up to its sale year, a few dozen rows
+    leases, _ = predict_listings(sweep_listings(listing, pd.DataFrame({'lease_commence_date': range(SWEEP_FIRST_LEASE_YEAR, listing['year'] + 1)})))
+    return leases
 
-flat_types = {'2-ROOM': 1, '3-ROOM': 2, '4-ROOM': 3, '5-ROOM': 4, 'EXECUTIVE': 5, 'MULTI-GENERATION': 6}
 
-flat_models = ['3Gen', 'Apartment', 'Improved-Maisonette', 'Maisonette', 'Model A', 'Model A-Maisonette', 'New Generation', 'Premium Apartment Loft', 'Premium Maisonette', 'Special', 'Standard']
+def nearest(values, value):
+    return min(values, key=lambda v: abs(v - value))
 
-prefixed_models = ['model_' + model for model in flat_models]
 
-towns = list(regions_mapper.keys())
+def sweep_curve(grid, axis, chosen, through_flat):
+    # price per model along one axis of the sweep, either with the other axes held at the chosen flat or averaged
+    # over all their values (partial dependence)
+    if through_flat:
+        grid = grid[np.logical_and.reduce([grid[other] == value for other, value in chosen.items() if other != axis])]
+    return grid.groupby(axis)[list(RESALE_MODELS)].mean()
 
-prefixed_towns = ['town_' + town for town in towns]
 
-streets_amenities = pd.read_csv('auxillary/streets_towns_amenities.csv')
+encoder = load_encoder()
 
-cpi_df = pd.read_csv('auxillary/cpi_mod.csv')
+resale_models = {name: load_ml_model(path) for name, path in RESALE_MODELS.items()}
 
-rf_pred, vot_pred, stk_pred = load_ml_model('models/resale/random_forest_model.pkl'), load_ml_model('models/resale/voting_regressor.pkl'), load_ml_model('models/resale/stacking_regressor.pkl')
+prediction_cache = load_prediction_cache(resale_models)
+
+backend = chart_backend()
+priced = sweep = False
 
 clx, cly, clz = st.columns([1.08,1.6,1])
 with cly:
@@ -75,22 +96,22 @@ st.divider()
 colA, colB, colC = st.columns([1, 1.5, 1])
 
 with colB:    
-    town = st.selectbox(key='town', label='Select town', index=None, options=towns)
+    town = st.selectbox(key='town', label='Select town', index=None, options=RESALE_TOWNS)
 
 if town:
     colx, coly, colz = st.columns([1,1.5,1])
 
     with coly:
-        streets = streets_amenities[streets_amenities['town'] == town]['street_name']
+        streets = encoder.streets_in(town)
         street = st.selectbox(key='street', label='Select street', index=None, options=streets)
 
     st.html("""<br></br>""")
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        flat_type = st.selectbox(key='flat_type', label='Select flat type', options=list(flat_types.keys()), index=None)
+        flat_type = st.selectbox(key='flat_type', label='Select flat type', options=list(FLAT_TYPES.keys()), index=None)
     with col2:
-        flat_model = st.selectbox(key='flat_model', label='Select flat model', options=flat_models, index=None)
+        flat_model = st.selectbox(key='flat_model', label='Select flat model', options=FLAT_MODELS, index=None)
     with col3:
         storey_range = st.number_input(key='storey_range', label='Enter storey range', value=2, step=1)
     with col4:
@@ -102,26 +123,94 @@ if town:
     with col6:
         year = st.selectbox(key='year', label='Year at which resale is expected', options=[2024, 2023, 2022, 2021])
     with col7:
-        month = st.selectbox(key='month', label='Month at which resale is expected', options=list(months.keys()) if year < 2024 else ['January', 'Febraury'])
+        month = st.selectbox(key='month', label='Month at which resale is expected', options=list(MONTHS.keys()) if year < 2024 else ['January', 'Febraury'])
 
     st.divider()
     clmA, clmB = st.columns([0.05,1])
     with clmB:
         if all([street, flat_type, flat_model, storey_range, floor_area, lease_comm, year, month]):
             df = create_df_for_prediction(town, lease_comm, flat_model, year, street, storey_range, flat_type, floor_area)
-
-            rf_pred_val = rf_pred.predict(df)
-            vot_pred_val = vot_pred.predict(df)
-            stk_pred_val = stk_pred.predict(df)
-
-            col8, col9, col10 = st.columns([1,1,1])
-            with col9:
-                st.subheader("Predicted Resale Prices")
+            if df is None:
+                st.warning('This flat cannot be priced, check its town, street, flat type, flat model and sale month.')
+            else:
+                predictions = prediction_cache.predict(df.to_numpy())
+                rf_pred_val = predictions['random_forest']
+                vot_pred_val = predictions['voting_regressor']
+                stk_pred_val = predictions['stacking_regressor']
+
+                col8, col9, col10 = st.columns([1,1,1])
+                with col9:
+                    st.subheader("Predicted Resale Prices")
             
-            clm1, clm2, clm3, clm4 = st.columns([0.1,1,1,1])
-            with clm2:
-                st.metric(label=f"Random Forest model predicted price: ", value='SGD ' + str(round(rf_pred_val[0])))
-            with clm3:
-                st.metric(label=f"Voting regressor model predicted price: ", value='SGD ' + str(round(vot_pred_val[0])))
-            with clm4:
-                st.metric(label=f"Stacking regressor model predicted price: ", value='SGD ' + str(round(stk_pred_val[0])))
\ No newline at end of file
+                clm1, clm2, clm3, clm4 = st.columns([0.1,1,1,1])
+                with clm2:
+                    st.metric(label=f"Random Forest model predicted price: ", value='SGD ' + str(round(rf_pred_val[0])))
+                with clm3:
+                    st.metric(label=f"Voting regressor model predicted price: ", value='SGD ' + str(round(vot_pred_val[0])))
+                with clm4:
+                    st.metric(label=f"Stacking regressor model predicted price: ", value='SGD ' + str(round(stk_pred_val[0])))
+                stats = prediction_cache.stats()
+                st.caption(f"Prediction cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries")
+                priced = True
+
+if priced:
+    st.divider()
+    st.subheader('What-if sweep')
+    st.markdown('How the predicted price of this flat changes with its storey, floor area, sale month and lease commencement year.')
+    sweep = st.toggle(key='sweep', label='Price the variations', help='Prices thousands of variations of the flat with each model')
+
+if priced and sweep:
+    sw1, sw2, sw3 = st.columns(3)
+    with sw1:
+        storeys = st.slider(key='sweep_storeys', label='Storeys', min_value=SWEEP_STOREYS[0], max_value=SWEEP_STOREYS[1], value=SWEEP_STOREYS)
+    with sw2:
+        # centred on the flat when the sweep is first shown, and left alone when the flat's floor area changes after
+        area = SWEEP_FLOOR_AREA_STEP * round(floor_area / SWEEP_FLOOR_AREA_STEP)
+        st.session_state.setdefault('sweep_floor_areas', (max(30, area - 30), min(300, area + 30)))
+        floor_areas = st.slider(key='sweep_floor_areas', label='Floor areas (in sqm)', min_value=30, max_value=300, step=SWEEP_FLOOR_AREA_STEP)
+    with sw3:
+        through_flat = st.radio(key='sweep_curves', label='Curves', options=['Through this flat', 'Averaged over the other variations']) == 'Through this flat'
+
+    storey_values = tuple(range(storeys[0], storeys[1] + 1))
+    floor_area_values = tuple(map(float, range(floor_areas[0], floor_areas[1] + 1, SWEEP_FLOOR_AREA_STEP)))
+    listing = {'town': town, 'street_name': street, 'flat_type': flat_type, 'flat_model': flat_model, 'storey_range': storey_range,
+               'floor_area_sqm': floor_area, 'lease_commence_date': lease_comm, 'year': year, 'month': MONTHS[month]}
+    grid = price_grid({field: value for field, value in listing.items() if field not in SWEEP_FIELDS}, storey_values, floor_area_values)
+    leases = price_leases(listing)
+    st.caption(f'{len(grid) + len(leases):,} variations priced by each model')
+
+    # the curves through the flat hold the other axes at the grid values nearest to it
+    chosen = {'storey_range': nearest(storey_values, storey_range), 'floor_area_sqm': nearest(floor_area_values, floor_area),
+              'sale_month': pd.Period(year=year, month=MONTHS[month], freq='M')}
+    chart_options = {'ylabel': 'Predicted price (SGD)', 'legend': 'model', 'figsize': (6.4, 4.8)}
+    curves = st.columns(2)
+    for i, (axis, label) in enumerate(SWEEP_AXES.items()):
+        with curves[i % 2]:
+            show_chart('line', sweep_curve(grid, axis, chosen, through_flat), backend, title=f'Predicted price by {label.lower()}', xlabel=label, **chart_options)
+    with curves[1]:
+        show_chart('line', leases.groupby('lease_commence_date')[list(RESALE_MODELS)].mean(), backend, title='Predicted price by lease commencement year',
+                   xlabel='Lease commencement year', **chart_options)
+
+    # storey against floor area, the models' mean price at the chosen sale month or over all of them
+    prices = grid[grid['sale_month'] == chosen['sale_month']] if through_flat else grid
+    prices = prices.assign(price=prices[list(RESALE_MODELS)].mean(axis=1)).pivot_table(index='storey_range', columns='floor_area_sqm', values='price')
+    show_chart('heatmap', prices, backend, title='Mean predicted price by storey and floor area', xlabel=SWEEP_AXES['floor_area_sqm'],
+               ylabel=SWEEP_AXES['storey_range'], legend='SGD', figsize=(10, 5.8))
+
+st.divider()
+with st.expander('Batch prediction from a CSV of listings'):
+    st.markdown(f"Upload one listing per row with the columns `{'`, `'.join(RESALE_LISTING_COLUMNS)}` (month as a number from 1 to 12).")
+    uploaded = st.file_uploader(key='listings', label='Upload listings', type='csv')
+    if uploaded is not None:
+        listings = pd.read_csv(uploaded)
+        missing = [col for col in RESALE_LISTING_COLUMNS if col not in listings.columns]
+        if missing:
+            st.error(f"Missing column(s): {', '.join(missing)}")
+        else:
+            results, valid = predict_listings(listings)
+            if not valid.all():
+                st.warning(f'{(~valid).sum()} listing(s) could not be priced, check their town, street, flat type, flat model and month.')
+            st.dataframe(results)
+            st.download_button(label='Download predictions', data=results.to_csv(index=False), file_name='resale_predictions.csv', mime='text/csv')
+
+finish_rerun()
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import AdaBoostRegressor, ExtraTreesRegressor, RandomForestRegressor, StackingRegressor, VotingRegressor
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.neighbors import KNeighborsRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+from custom_scripts.trees import compile_model, parity_inputs
+
+# Parity of the flattened evaluators in custom_scripts.trees with the libraries they replace. Each supported estimator
+# is fitted small and the compiled model must predict exactly what the estimator predicts, on random rows and on rows
+# placed on and around every split threshold. Run from the dashboard directory:
+#   python -m pytest tests
+
+
+def _data(n_rows=300, n_features=4, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features)) * [1, 10, 1000, 0.01][:n_features]
+    y = X @ rng.normal(size=n_features) + rng.normal(size=n_rows)
+    return X, y
+
+
+def _forest():
+    return RandomForestRegressor(n_estimators=8, max_depth=6, random_state=0)
+
+
+def _stacking(passthrough):
+    return StackingRegressor([('rf', _forest()), ('et', ExtraTreesRegressor(n_estimators=4, random_state=0)), ('lr', LinearRegression())],
+                             final_estimator=Ridge(), passthrough=passthrough, cv=3)
+
+
+ESTIMATORS = {
+    'tree': lambda: DecisionTreeRegressor(max_depth=8, random_state=0),
+    'random forest': _forest,
+    'extra trees': lambda: ExtraTreesRegressor(n_estimators=8, random_state=0),
+    'adaboost': lambda: AdaBoostRegressor(DecisionTreeRegressor(max_depth=4), n_estimators=10, random_state=0),
+    'voting': lambda: VotingRegressor([('rf', _forest()), ('lr', LinearRegression())], weights=[2, 1]),
+    'stacking': lambda: _stacking(False),
+    'stacking with passthrough': lambda: _stacking(True),
+}
+
+
+def _assert_parity(estimator, X):
+    compiled = compile_model(estimator)
+    for rows in [X, parity_inputs(compiled, 2000)]:
+        np.testing.assert_array_equal(compiled.predict(rows), estimator.predict(rows))
+
+
+@pytest.mark.parametrize('name', ESTIMATORS)
+def test_sklearn_parity(name):
+    X, y = _data()
+    _assert_parity(ESTIMATORS[name]().fit(X, y), X)
+
+
+def test_xgboost_parity():
+    xgboost = pytest.importorskip('xgboost')
+    X, y = _data()
+    _assert_parity(xgboost.XGBRegressor(n_estimators=20, max_depth=4).fit(X, y), X)
+
+
+def test_float32_threshold_ties():
+    # sklearn splits halfway between two float32 values in float64, a threshold float32 cannot hold; rows on the
+    # float32 values either side of it and on its float32 rounding must land on the same side as in sklearn
+    low = np.float32(0.1)
+    high = np.nextafter(low, np.float32(1))
+    X = np.array([[low], [high]], dtype=np.float64)
+    tree = DecisionTreeRegressor().fit(X, [0., 1.])
+    threshold = tree.tree_.threshold[0]
+    rows = np.array([[low], [high], [np.float32(threshold)], [threshold], [np.nextafter(threshold, 1)]])
+    np.testing.assert_array_equal(compile_model(tree).predict(rows), tree.predict(rows))
+
+
+def test_xgboost_threshold_ties():
+    # XGBoost sends x < condition left, a row exactly on a split condition goes right
+    xgboost = pytest.importorskip('xgboost')
+    X = np.repeat([[0.], [1.], [2.]], 20, axis=0)
+    model = xgboost.XGBRegressor(n_estimators=2, max_depth=2).fit(X, X[:, 0] ** 2)
+    rows = np.array([[0.], [0.5], [1.], [1.5], [2.], *parity_inputs(compile_model(model), 50)])
+    np.testing.assert_array_equal(compile_model(model).predict(rows), model.predict(rows))
+
+
+def test_knn_not_implemented():
+    X, y = _data()
+    with pytest.raises(NotImplementedError):
+        compile_model(KNeighborsRegressor().fit(X, y))
+    with pytest.raises(NotImplementedError):
+        compile_model(VotingRegressor([('rf', _forest()), ('knn', KNeighborsRegressor())]).fit(X, y))